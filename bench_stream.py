@@ -0,0 +1,111 @@
+# bench_stream.py
+"""
+Micro-benchmark of the Ollama stream decoding in ask_ai: the previous line-based
+decoder (iter_lines, decode to str, json.loads) against ollama_integration's bytes-level
+NDJSONDecoder, with the standard json module and with orjson when it is installed.
+
+    python bench_stream.py --tokens 20000 --repeat 5
+
+The stream is replayed from memory one HTTP chunk per line, as Ollama sends it, so only
+the per-token decoding work on the worker thread is measured.
+"""
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+import ollama_integration
+
+class _ReplayRaw:
+    """Stands in for urllib3's response: yields pre-recorded chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def stream(self, amt=None, decode_content=True):
+        yield from self.chunks
+
+def _response(chunks):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.raw = _ReplayRaw(chunks)
+    return response
+
+def make_stream(tokens):
+    """One NDJSON line per token in Ollama's format, plus the final statistics chunk."""
+    chunks = []
+    for i in range(tokens):
+        chunks.append(json.dumps({
+            "model": ollama_integration.OLLAMA_MODEL,
+            "created_at": "2024-01-01T00:00:00.000000Z",
+            "response": f" word{i % 50}",
+            "done": False,
+        }).encode("utf-8") + b"\n")
+    chunks.append(json.dumps({
+        "model": ollama_integration.OLLAMA_MODEL, "response": "", "done": True,
+        "context": list(range(2048)), "eval_count": tokens, "eval_duration": tokens * 10_000_000,
+    }).encode("utf-8") + b"\n")
+    return chunks
+
+def decode_lines(response):
+    """The decoder ask_ai used before NDJSONDecoder."""
+    for chunk in response.iter_lines():
+        if chunk:
+            try:
+                chunk_data = json.loads(chunk.decode("utf-8"))
+            except json.JSONDecodeError:
+                continue
+            if chunk_data.get("response"):
+                yield chunk_data["response"]
+
+def decode_ndjson(response):
+    for chunk_data in ollama_integration._iter_ndjson(response):
+        piece = chunk_data.get("response")
+        if piece:
+            yield piece
+
+def bench(decoder, chunks, repeat):
+    """Best wall time over 'repeat' runs and the number of pieces produced."""
+    best = None
+    for _ in range(repeat):
+        response = _response(chunks)
+        started = time.perf_counter()
+        pieces = sum(1 for _ in decoder(response))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, pieces
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Ollama stream decoding.")
+    parser.add_argument("--tokens", type=int, default=20000, help="Tokens in the replayed stream")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per decoder (the best is reported)")
+    args = parser.parse_args(argv)
+
+    chunks = make_stream(args.tokens)
+    fast_loads = ollama_integration._json_loads
+    candidates = [("iter_lines + str + json", decode_lines, json.loads),
+                  ("NDJSONDecoder + json", decode_ndjson, ollama_integration._stdlib_json_loads)]
+    if fast_loads is not ollama_integration._stdlib_json_loads:
+        candidates.append(("NDJSONDecoder + orjson", decode_ndjson, fast_loads))
+    else:
+        print("orjson is not installed; skipping the orjson run (pip install orjson)")
+
+    baseline = None
+    for name, decoder, loads in candidates:
+        ollama_integration._json_loads = loads
+        try:
+            elapsed, pieces = bench(decoder, chunks, args.repeat)
+        finally:
+            ollama_integration._json_loads = fast_loads
+        if pieces != args.tokens:
+            print(f"{name}: produced {pieces} pieces, expected {args.tokens}")
+            return 1
+        baseline = baseline or elapsed
+        print(f"{name:<26} {elapsed * 1000:8.1f} ms  {args.tokens / elapsed:>10,.0f} tokens/s  "
+              f"{elapsed / args.tokens * 1e6:6.2f} us/token  x{baseline / elapsed:.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Pre-generated curriculum answers (see pregenerate.py)
+PACK_FILENAME = "content_pack.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pack_entries (
+    prompt_key TEXT PRIMARY KEY,
+    class_number INTEGER,
+    subject TEXT,
+    unit_number TEXT,
+    topic TEXT,
+    model TEXT,
+    response BLOB NOT NULL,
+    audio BLOB,
+    created_at REAL
+);
+"""
+
+def prompt_key(prompt, system=None):
+    """Entries are addressed by the exact prompt (and system prompt) the app would send to the LLM."""
+    material = prompt if not system else f"{system}\n\n{prompt}"
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ContentPack:
+    """
+    A single SQLite file holding zlib-compressed answers (and optional MP3 narration)
+    for curriculum prompts, so the app can serve them without calling the LLM.
+    """
+
+    def __init__(self, path=PACK_FILENAME):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def keys(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT prompt_key FROM pack_entries")}
+
+    def get(self, prompt, system=None):
+        """Returns (response, audio_mp3_or_None) for 'prompt', or None if it is not in the pack."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, audio FROM pack_entries WHERE prompt_key=?", (prompt_key(prompt, system),)
+            ).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode("utf-8"), row[1]
+
+    def put(self, prompt, response, class_number=None, subject=None, unit_number=None,
+            topic=None, model=None, audio=None, system=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pack_entries "
+                "(prompt_key, class_number, subject, unit_number, topic, model, response, audio, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (prompt_key(prompt, system), class_number, subject, unit_number, topic, model,
+                 zlib.compress(response.encode("utf-8"), 9), audio, time.time()),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_content_pack(path=PACK_FILENAME):
+    """Returns the ContentPack at 'path', or None if no pack has been generated."""
+    if not os.path.exists(path):
+        return None
+    return ContentPack(path)
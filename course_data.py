@@ -837,26 +837,65 @@ def get_class_subjects(class_number):
     else:
         return []
 
+class_data_map = {
+    10: class10_data,
+    9: class9_data,
+    8: class8_data,
+    7: class7_data,
+    6: class6_data,
+    5: class5_data,
+    4: class4_data,
+    3: class3_data,
+    2: class2_data,
+    1: class1_data
+}
+
 def get_class_units(class_number, subject):
-    class_data_map = {
-        10: class10_data,
-        9: class9_data,
-        8: class8_data,
-        7: class7_data,
-        6: class6_data,
-        5: class5_data,
-        4: class4_data,
-        3: class3_data,
-        2: class2_data,
-        1: class1_data
-    }
     if class_number in class_data_map:
         class_data = class_data_map[class_number]
         if subject in class_data:
             return class_data[subject]["units"]
     return {}  # Return empty dictionary if data doesn't exist
 
+def iter_curriculum(class_numbers=range(1, 11)):
+    """Yields (class_number, subject, unit_number, topic) for every topic in the curriculum."""
+    for class_number in class_numbers:
+        for subject, subject_data in class_data_map.get(class_number, {}).items():
+            for unit_number, unit_data in subject_data["units"].items():
+                for topic in unit_data.get("topics", {}):
+                    yield class_number, subject, unit_number, topic
+
+# Generation limits by class level: (lowest class number, Ollama options). Younger classes get
+# shorter, more focused answers, which also frees the inference host sooner. There is no num_ctx
+# here: every request uses ollama_integration.OLLAMA_NUM_CTX, since changing it reloads the model.
+GENERATION_PROFILES = (
+    (1, {"num_predict": 200, "temperature": 0.5}),
+    (4, {"num_predict": 350, "temperature": 0.6}),
+    (7, {"num_predict": 550, "temperature": 0.7}),
+    (9, {"num_predict": 800, "temperature": 0.7}),
+)
+
+def generation_options(class_number):
+    """Ollama generation options (max tokens, temperature) for a class level."""
+    options = None
+    for lowest_class, profile in GENERATION_PROFILES:
+        if class_number >= lowest_class:
+            options = profile
+    return dict(options) if options else None
+
+def build_llm_system_prompt(class_number, subject):
+    """
+    Fixed instructions for one class and subject. They are sent as the model's system prompt,
+    identical for every topic, so the server can reuse their cached prefill across students.
+    """
+    return (
+        f"You are teaching Class {class_number} {subject}.\n"
+        f"For each unit and topic you are given, provide an engaging and detailed explanation "
+        f"of the topic, and suggest further related topics for the user to explore.\n"
+    )
+
 def build_llm_prompt(class_number, subject, unit_number, topic):
+    """The variable part of a topic request; pair it with build_llm_system_prompt()."""
     if class_number not in range(1, 11):
         return "Invalid class number."
 
@@ -872,9 +911,4 @@ def build_llm_prompt(class_number, subject, unit_number, topic):
     if topic not in topics:
         return "Invalid topic."
 
-    return (
-        f"You are teaching Class {class_number} {subject}.\n"
-        f"The current unit is '{unit_data['name']}', and the topic is '{topic}'.\n\n"
-        f"Please provide an engaging and detailed explanation about the topic '{topic}', "
-        f"and suggest further related topics for the user to explore.\n"
-    )
+    return f"The current unit is '{unit_data['name']}', and the topic is '{topic}'.\n"
@@ -1,16 +1,16 @@
-from ollama_integration import ask_ollama
+from ollama_integration import ask_ai
+
+# Kept identical for every question so the server can reuse its prefill
+EXPERT_SYSTEM_PROMPT = (
+    "You are a highly knowledgeable science tutor. "
+    "Explain concepts step by step and provide relevant details, "
+    "but keep it clear and concise."
+)
 
 def expert_mode_query(question):
     """
     Compose a specialized prompt for the 'Science Expert Mode'.
     This can be improved with instructions, conversation context, etc.
     """
-    system_prompt = (
-        "You are a highly knowledgeable science tutor. "
-        "Explain concepts step by step and provide relevant details, "
-        "but keep it clear and concise. "
-        "The user asks:\n"
-    )
-    full_prompt = system_prompt + question.strip()
-    response = ask_ollama(full_prompt)
+    response = ask_ai(question.strip(), system=EXPERT_SYSTEM_PROMPT)
     return response
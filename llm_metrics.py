@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from db import DB_FILENAME
+
+# One JSON object per LLM request, stored next to the main tutor database
+METRICS_FILENAME = os.path.join(os.path.dirname(DB_FILENAME), "llm_metrics.jsonl")
+METRICS_RECENT = 500  # Records kept in memory for the in-app view
+
+# Columns of a record, in display order
+METRICS_FIELDS = ("time", "backend", "host", "cache", "status", "queue_wait", "connect", "ttft",
+                  "total", "tokens", "tokens_per_second", "prompt_tokens")
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class MetricsRecorder:
+    """
+    Collects one record per LLM request: a ring buffer of the most recent ones for the
+    UI, plus an append-only JSONL file ('path'; None keeps records in memory only).
+    """
+
+    def __init__(self, path=METRICS_FILENAME, recent=METRICS_RECENT):
+        self.path = path
+        self._recent = deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        record = {"time": time.time(), **record}
+        with self._lock:
+            self._recent.append(record)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    logging.debug(f"Could not write LLM metrics: {e}")
+
+    def recent(self, limit=None):
+        """The most recent records, newest last."""
+        with self._lock:
+            records = list(self._recent)
+        return records[-limit:] if limit else records
+
+    def summary(self):
+        """Request counts, cache hit rate and p50/p95 of the timing fields over the recent records."""
+        records = self.recent()
+        summary = {
+            "requests": len(records),
+            "cache_hits": sum(1 for r in records if r.get("cache") == "hit"),
+            "errors": sum(1 for r in records if r.get("status") == "error"),
+        }
+        for field in ("queue_wait", "ttft", "total", "tokens_per_second"):
+            values = [r[field] for r in records if r.get(field) is not None]
+            if values:
+                summary[f"{field}_p50"] = _percentile(values, 0.5)
+                summary[f"{field}_p95"] = _percentile(values, 0.95)
+        return summary
+
+_default_recorder = None
+_default_recorder_lock = threading.Lock()
+
+def get_metrics_recorder():
+    """Returns the process-wide MetricsRecorder, creating it on first use."""
+    global _default_recorder
+    with _default_recorder_lock:
+        if _default_recorder is None:
+            _default_recorder = MetricsRecorder()
+        return _default_recorder
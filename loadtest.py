@@ -0,0 +1,176 @@
+# loadtest.py
+"""
+Drives N simulated students through the tutor flow concurrently and reports latency
+percentiles. Each student picks a curriculum topic (the topic-selection request), then
+asks follow-up questions in one conversation (the free-chat request), as the app does.
+
+    python loadtest.py --students 20 --stub              # against an in-process stub_ollama
+    python loadtest.py --students 20 --stub --stub-hosts 3   # balanced across three stubs
+    python loadtest.py --students 8 --host 10.0.0.5      # against a real Ollama server
+
+Run it before and after every change to the LLM path and compare the reports.
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ollama_integration
+from course_data import build_llm_prompt, build_llm_system_prompt, generation_options, iter_curriculum
+
+FOLLOW_UPS = (
+    "Can you explain that more simply?",
+    "Give me an example from everyday life.",
+    "Why does that happen?",
+    "What should I learn next?",
+)
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class LoadTestResults:
+    """Thread-safe collection of (kind, ttft, total, tokens, ok) samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+
+    def add(self, kind, ttft, total, tokens, ok):
+        with self._lock:
+            self.samples.append((kind, ttft, total, tokens, ok))
+
+    def report(self, elapsed):
+        """Percentiles per request kind and overall, as a dict."""
+        report = {"elapsed": elapsed, "kinds": {}}
+        for kind in sorted({s[0] for s in self.samples}) + ["all"]:
+            samples = [s for s in self.samples if kind in ("all", s[0])]
+            ok = [s for s in samples if s[4]]
+            entry = {"requests": len(samples), "errors": len(samples) - len(ok)}
+            for name, index in (("ttft", 1), ("total", 2)):
+                values = [s[index] for s in ok if s[index] is not None]
+                if values:
+                    for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99)):
+                        entry[f"{name}_{label}"] = _percentile(values, fraction)
+                    entry[f"{name}_max"] = max(values)
+            entry["tokens_per_second"] = sum(s[3] or 0 for s in ok) / elapsed if elapsed else 0.0
+            entry["requests_per_second"] = len(ok) / elapsed if elapsed else 0.0
+            report["kinds"][kind] = entry
+        return report
+
+def _timed(results, kind, stream):
+    """Consumes 'stream' (a stream_ai-style generator bound to a meta dict) and records its timings."""
+    generator, meta = stream
+    started = time.perf_counter()
+    first_token = None
+    ok = True
+    try:
+        for _ in generator:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+    except Exception as e:
+        logging.debug(f"{kind} request failed: {e}")
+        ok = False
+    ok = ok and "error" not in meta
+    results.add(kind, first_token, time.perf_counter() - started, meta.get("eval_count"), ok)
+
+def run_student(student, topics, follow_ups, results, model, think_time, seed):
+    """One simulated student: a topic explanation, then 'follow_ups' questions in a conversation."""
+    rng = random.Random(seed + student)
+    class_number, subject, unit_number, topic = rng.choice(topics)
+    prompt = build_llm_prompt(class_number, subject, unit_number, topic)
+    system = build_llm_system_prompt(class_number, subject)
+    options = generation_options(class_number)
+    meta = {}
+    _timed(results, "topic", (ollama_integration.stream_ai(prompt, model=model, raise_errors=True,
+                                                           system=system, options=options, meta=meta,
+                                                           priority=ollama_integration.PRIORITY_COURSE,
+                                                           user=student), meta))
+
+    conversation = ollama_integration.Conversation(model=model, system=system)
+    for _ in range(follow_ups):
+        time.sleep(rng.uniform(0, think_time))
+        meta = {}
+        question = f"{rng.choice(FOLLOW_UPS)} ({topic})"
+        _timed(results, "chat", (conversation.stream(question, raise_errors=True, options=options,
+                                                                 meta=meta, user=student), meta))
+
+def run_load_test(students=10, follow_ups=2, model="ollama", think_time=1.0, classes=range(1, 11), seed=0,
+                  retries=0):
+    """
+    Runs 'students' concurrent students and returns the report dict. HTTP retries are off by
+    default ('retries'), so every failed request shows up in the report instead of being
+    silently replayed.
+    """
+    topics = list(iter_curriculum(classes))
+    ollama_integration.configure_http(pool_size={"ollama": students}, retries=retries,
+                                      max_concurrent={"ollama": students})
+    results = LoadTestResults()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=students) as pool:
+        futures = [pool.submit(run_student, student, topics, follow_ups, results, model, think_time, seed)
+                   for student in range(students)]
+        for future in futures:
+            future.result()
+    return results.report(time.perf_counter() - started)
+
+def format_report(report):
+    lines = [f"Elapsed {report['elapsed']:.1f}s"]
+    for kind, entry in report["kinds"].items():
+        line = f"{kind:>6}: {entry['requests']} requests, {entry['errors']} errors"
+        for name in ("ttft", "total"):
+            if f"{name}_p50" in entry:
+                line += (f" | {name} p50 {entry[name + '_p50']:.2f}s p95 {entry[name + '_p95']:.2f}s"
+                         f" p99 {entry[name + '_p99']:.2f}s")
+        line += f" | {entry['tokens_per_second']:.1f} tok/s"
+        lines.append(line)
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the LLM path with simulated students.")
+    parser.add_argument("--students", type=int, default=10, help="Concurrent simulated students")
+    parser.add_argument("--follow-ups", type=int, default=2, help="Chat questions per student after the topic")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Max seconds a student waits between questions")
+    parser.add_argument("--model", default="ollama", help="'ollama', 'gemini' or 'auto'")
+    parser.add_argument("--host", default=ollama_integration.OLLAMA_HOST, help="Ollama host")
+    parser.add_argument("--port", type=int, default=ollama_integration.OLLAMA_PORT, help="Ollama port")
+    parser.add_argument("--stub", action="store_true", help="Start an in-process stub_ollama server and use it")
+    parser.add_argument("--stub-hosts", type=int, default=1, help="Stub servers to start and balance across")
+    parser.add_argument("--stub-tokens-per-second", type=float, default=None)
+    parser.add_argument("--stub-first-token-delay", type=float, default=None)
+    parser.add_argument("--stub-failure-rate", type=float, default=None)
+    parser.add_argument("--stub-failure-mode", choices=("http", "drop"), default=None,
+                        help="'http' answers 503, 'drop' cuts the stream half way")
+    parser.add_argument("--http-retries", type=int, default=0, help="HTTP retries per request (off by default)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for topic and question choice")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    ollama_integration.OLLAMA_HOST = args.host
+    ollama_integration.OLLAMA_PORT = args.port
+    if args.stub:
+        from stub_ollama import start_stub_server
+        settings = {name: value for name, value in (
+            ("tokens_per_second", args.stub_tokens_per_second),
+            ("first_token_delay", args.stub_first_token_delay),
+            ("failure_rate", args.stub_failure_rate),
+            ("failure_mode", args.stub_failure_mode),
+        ) if value is not None}
+        servers = [start_stub_server(seed=args.seed + i, **settings) for i in range(max(1, args.stub_hosts))]
+        ollama_integration.OLLAMA_HOST = "127.0.0.1"
+        ollama_integration.OLLAMA_PORT = servers[0].port
+        # With several stubs the requests go through the BackendPool like a multi-server lab
+        ollama_integration.OLLAMA_HOSTS = [("127.0.0.1", server.port) for server in servers] if len(servers) > 1 else []
+
+    report = run_load_test(args.students, args.follow_ups, args.model, args.think_time, seed=args.seed,
+                           retries=args.http_retries)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 1 if report["kinds"]["all"]["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@ import warnings
 import logging
 from PyQt5.QtWidgets import QApplication
 from db import init_db
+from ollama_integration import start_warm_up, release_model
 from stt import OfflineSTT
 from tts import OfflineTTS
 from ui_mainwindow import MainWindow
@@ -25,15 +26,23 @@ def main():
     # 1. Initialize DB
     init_db()
 
-    # 2. Initialize STT and TTS engines
+    # 2. Preload the Ollama model in the background while Whisper loads
+    start_warm_up()
+
+    # 3. Initialize STT and TTS engines
     stt_engine = OfflineSTT()    # Loads Whisper model
     tts_engine = OfflineTTS()    # pyttsx3-based TTS
 
-    # 3. Launch PyQt Application
+    # 4. Launch PyQt Application
     app = QApplication(sys.argv)
     window = MainWindow(stt_engine, tts_engine)
     window.show()
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+
+    # 5. Stop speech; the model is only unloaded if OLLAMA_RELEASE_ON_EXIT allows it
+    tts_engine.shutdown()
+    release_model()
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+import aiohttp
+import requests
+import ollama_integration
+from ollama_integration import PRIORITY_INTERACTIVE, GenerationCancelled, GenerationPreempted
+
+# Defaults for the asyncio client
+ASYNC_MAX_CONCURRENT = 4      # Generations in flight at once across all backends
+ASYNC_TOTAL_TIMEOUT = 300     # Seconds for a whole generation; connect/read timeouts come from the breakers
+
+class _AsyncFlight:
+    """One upstream generation whose pieces are replayed to every subscriber on the loop."""
+
+    def __init__(self):
+        self.pieces = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cond = asyncio.Condition()
+        self.meta = {}
+        self.task = None
+
+class AsyncLLMClient:
+    """
+    asyncio counterpart of ollama_integration.stream_ai / ask_ai. One client owns a
+    keep-alive aiohttp session and a semaphore bounding the generations in flight.
+    Requests go through the same layers as the blocking path: backend slots granted by
+    priority (SlotScheduler), circuit breakers with adaptive timeouts, coalescing of
+    identical requests, and the request steps shared with stream_ai (response cache and
+    fallback, error notices, llm_metrics). "auto" routing is only available in stream_ai.
+    Cancel a generation by cancelling the task that iterates it.
+    """
+
+    def __init__(self, max_concurrent=ASYNC_MAX_CONCURRENT, total_timeout=ASYNC_TOTAL_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.total_timeout = total_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._session = None
+        self._flights = {}  # (request key, priority) -> _AsyncFlight currently generating
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrent * 2, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @asynccontextmanager
+    async def _held_slot(self, backend, meta, priority, user):
+        """
+        Async version of ollama_integration._held_slot: waits for a slot of the shared
+        SlotScheduler on a worker thread. Preemption cancels the task holding the slot,
+        which surfaces as GenerationPreempted.
+        """
+        loop = asyncio.get_running_loop()
+        scheduler = ollama_integration._backend_slot(backend)
+        cancel = ollama_integration.CancelToken()
+        started = time.perf_counter()
+        waiting = loop.run_in_executor(None, scheduler.acquire, priority, user, cancel)
+        try:
+            grant = await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            cancel.cancel()  # Stops the waiting thread; a slot granted meanwhile is handed back
+
+            def give_back(future):
+                if not future.cancelled() and future.exception() is None:
+                    scheduler.release(future.result())
+
+            waiting.add_done_callback(give_back)
+            raise
+        meta["queue_wait"] = time.perf_counter() - started
+        task = asyncio.current_task()
+        held = [True]
+
+        def preempt():
+            loop.call_soon_threadsafe(lambda: held[0] and task.cancel())
+
+        grant.cancel.add_callback(preempt)
+        try:
+            yield
+        except asyncio.CancelledError:
+            if grant.preempted:
+                raise GenerationPreempted(f"{backend} slot taken by a higher-priority request") from None
+            raise
+        finally:
+            held[0] = False
+            grant.cancel.remove_callback(preempt)
+            scheduler.release(grant)
+
+    async def _stream_ollama(self, prompt, meta, timeout, context=None, system=None, options=None):
+        pool = ollama_integration.get_backend_pool()
+        host = pool.acquire()
+        url = f"{host.base_url}/api/generate"
+        payload = {
+            "model": ollama_integration.OLLAMA_MODEL,
+            "prompt": prompt,
+            "keep_alive": ollama_integration.current_keep_alive(),
+            "options": {"num_ctx": ollama_integration.OLLAMA_NUM_CTX, **(options or {})},
+            "stream": True
+        }
+        if context:
+            payload["context"] = context
+        if system:
+            payload["system"] = system
+        meta["backend"] = "ollama"
+        meta["host"] = host.base_url
+        logging.debug(f"Sending async request to Ollama: {url}")
+        started = time.perf_counter()
+        first_token = None
+        try:
+            async with self._get_session().post(url, json=payload, timeout=timeout) as response:
+                meta["connect"] = time.perf_counter() - started
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        chunk_data = ollama_integration._json_loads(line)
+                    except ValueError as e:
+                        logging.error(f"JSON decoding error: {e}")
+                        continue
+                    if chunk_data.get("response"):
+                        if first_token is None:
+                            first_token = time.perf_counter() - started
+                        yield chunk_data["response"]
+                    if chunk_data.get("done"):
+                        meta.update({k: chunk_data[k] for k in ollama_integration.OLLAMA_DONE_FIELDS
+                                     if k in chunk_data})
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pool.release(host, ok=False)
+            raise
+        except BaseException:
+            pool.release(host)
+            raise
+        pool.release(host, latency=first_token)
+
+    async def _stream_gemini(self, prompt, meta, timeout, context=None, system=None, options=None):
+        url = (f"{ollama_integration.GEMINI_URL}/{ollama_integration.GEMINI_MODEL}"
+               f":streamGenerateContent?alt=sse&key={ollama_integration.GEMINI_API_KEY}")
+        payload = {
+            "contents": [{
+                "parts": [{"text": prompt}]
+            }]
+        }
+        if system:
+            payload["systemInstruction"] = {"parts": [{"text": system}]}
+        if options and options.get("num_predict") is not None:
+            payload["generationConfig"] = {"maxOutputTokens": options["num_predict"]}
+        if options and options.get("temperature") is not None:
+            payload.setdefault("generationConfig", {})["temperature"] = options["temperature"]
+        meta["backend"] = "gemini"
+        logging.debug("Sending async request to Gemini")
+        started = time.perf_counter()
+        async with self._get_session().post(url, json=payload, timeout=timeout) as response:
+            meta["connect"] = time.perf_counter() - started
+            response.raise_for_status()
+            async for line in response.content:
+                if not line.startswith(b"data:"):
+                    continue
+                try:
+                    response_data = ollama_integration._json_loads(line[len(b"data:"):])
+                except ValueError as e:
+                    logging.error(f"JSON decoding error: {e}")
+                    continue
+                if "usageMetadata" in response_data:
+                    meta["eval_count"] = response_data["usageMetadata"].get("candidatesTokenCount")
+                    meta["prompt_eval_count"] = response_data["usageMetadata"].get("promptTokenCount")
+                for candidate in response_data.get("candidates", [])[:1]:
+                    for part in candidate.get("content", {}).get("parts", []):
+                        if part.get("text"):
+                            yield part["text"]
+
+    async def _guarded(self, backend, prompt, meta, priority=PRIORITY_INTERACTIVE, user=None, **params):
+        """
+        One upstream request under the backend's CircuitBreaker (fail fast while open,
+        adaptive timeouts), holding a client concurrency slot and a SlotScheduler slot.
+        """
+        breaker = ollama_integration.get_breaker(backend)
+        breaker.before_request()
+        connect, read = breaker.timeout()
+        timeout = aiohttp.ClientTimeout(total=self.total_timeout, sock_connect=connect, sock_read=read)
+        upstream = self._stream_ollama if backend == "ollama" else self._stream_gemini
+        started = time.perf_counter()
+        latency = None
+        try:
+            async with self._semaphore, self._held_slot(backend, meta, priority, user):
+                async for piece in upstream(prompt, meta, timeout, **params):
+                    if latency is None:
+                        latency = time.perf_counter() - started - meta.get("queue_wait", 0.0)
+                    yield piece
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ollama_integration.record_backend_failure(backend)
+            raise
+        except BaseException:
+            breaker.record_abandoned()
+            raise
+        breaker.record_success(latency)
+
+    async def _pump(self, key, flight, backend, prompt, params):
+        try:
+            async for piece in self._guarded(backend, prompt, flight.meta, **params):
+                async with flight.cond:
+                    flight.pieces.append(piece)
+                    flight.cond.notify_all()
+        except asyncio.CancelledError:
+            logging.debug("All subscribers left; abandoned shared async generation.")
+            flight.error = GenerationCancelled()  # The text is cut off: nobody may take it for a complete answer
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            async with flight.cond:
+                flight.cond.notify_all()
+
+    async def _coalesced(self, key, backend, prompt, meta, **params):
+        """Like ollama_integration._stream_coalesced, for requests made on this client's loop."""
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _AsyncFlight()
+            self._flights[key] = flight
+            flight.task = asyncio.get_running_loop().create_task(self._pump(key, flight, backend, prompt, params))
+        else:
+            logging.debug("Joining an identical in-flight async generation.")
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                async with flight.cond:
+                    await flight.cond.wait_for(lambda: index < len(flight.pieces) or flight.done)
+                    pieces = flight.pieces[index:]
+                    index = len(flight.pieces)
+                    done = flight.done
+                for piece in pieces:
+                    yield piece
+                if done:
+                    if flight.error:
+                        raise flight.error
+                    meta.update(flight.meta)
+                    meta["coalesced"] = not leader
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Forget the flight at once, so an identical request arriving now starts a fresh generation
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    async def stream(self, prompt, model="ollama", use_cache=False, raise_errors=False, context=None, system=None,
+                     options=None, priority=PRIORITY_INTERACTIVE, user=None, coalesce=True, meta=None):
+        """
+        Async generator yielding the response for 'prompt' piece by piece. Arguments behave
+        like stream_ai's; the cache, error notices, fallback and metrics are the same code
+        (ollama_integration._AIRequest), only the transport differs.
+        """
+        backend = model.lower()
+        if backend not in ("ollama", "gemini"):
+            if raise_errors:
+                raise ValueError(f"Unsupported model: {model}")
+            yield "Error: Unsupported model. Choose 'ollama' or 'gemini'."
+            return
+
+        loop = asyncio.get_running_loop()
+        request = ollama_integration._AIRequest(backend, prompt, use_cache, raise_errors, meta, priority,
+                                                context=context, system=system, options=options)
+        try:
+            cached = await loop.run_in_executor(None, request.cached)  # SQLite: kept off the loop
+            if cached is not None:
+                yield cached
+                return
+
+            if coalesce:
+                upstream = self._coalesced((request.key, priority), backend, prompt, request.meta,
+                                           priority=priority, user=user, **request.params)
+            else:
+                upstream = self._guarded(backend, prompt, request.meta, priority=priority, user=user,
+                                         **request.params)
+            async for piece in upstream:
+                request.piece(piece)
+                yield piece
+        except (asyncio.CancelledError, GeneratorExit):
+            request.cancelled()
+            raise
+        except GenerationCancelled:
+            request.cancelled(own=False)
+            return
+        except GenerationPreempted as e:
+            notice = request.preempted(e)
+            if raise_errors:
+                raise
+            yield notice
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError, requests.exceptions.RequestException) as e:
+            notice = await loop.run_in_executor(None, request.failed, e)
+            if raise_errors:
+                raise
+            yield notice
+            return
+        finally:
+            request.record()
+        await loop.run_in_executor(None, request.finish)
+
+    async def ask(self, prompt, model="ollama", on_token=None, **kwargs):
+        """Awaitable equivalent of ask_ai; keyword arguments go to stream()."""
+        full_response = []
+        async for piece in self.stream(prompt, model=model, **kwargs):
+            full_response.append(piece)
+            if on_token:
+                on_token(piece)
+        return ''.join(full_response).strip()
@@ -1,6 +1,41 @@
 import requests
+import collections
+import itertools
 import json
 import logging
+import queue
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from llm_metrics import get_metrics_recorder
+from response_cache import get_response_cache, make_cache_key
+
+_json_decoder = json.JSONDecoder()
+
+def _stdlib_json_loads(data):
+    """
+    Parses one NDJSON line (bytes) with the json module; raw_decode skips json.loads' whitespace
+    scans. Like orjson, it rejects a line with anything but whitespace after the object.
+    """
+    text = data.decode("utf-8")
+    try:
+        value, end = _json_decoder.raw_decode(text)
+    except ValueError:
+        return json.loads(text)  # Leading whitespace, or a genuine error with json's usual message
+    if end != len(text) and text[end:].strip():
+        return json.loads(text)  # Raises json's "Extra data" error
+    return value
+
+try:
+    import orjson  # Optional: parses the small objects Ollama streams several times faster than json
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = _stdlib_json_loads
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -8,69 +43,1549 @@ logging.basicConfig(level=logging.DEBUG)
 # Configuration for both APIs
 OLLAMA_HOST = "localhost"
 OLLAMA_PORT = 11434
+OLLAMA_HOSTS = []                # Several Ollama boxes, e.g. [("10.0.0.5", 11434), ("10.0.0.6", 11434)];
+                                 # when empty, OLLAMA_HOST/OLLAMA_PORT is the only host
+OLLAMA_MODEL = "qwen2.5-coder:0.5b"
+OLLAMA_KEEP_ALIVE = "10m"        # Model stays loaded this long after the last request
+OLLAMA_CLASS_HOURS = (8, 16)     # Local hours [start, end) during which OLLAMA_CLASS_KEEP_ALIVE applies
+OLLAMA_CLASS_KEEP_ALIVE = "2h"   # Keeps the model resident between lessons
+OLLAMA_RELEASE_ON_EXIT = False   # Unload the model when the tutor closes (never during class hours,
+                                 # since other students share it); otherwise keep_alive releases it
+OLLAMA_WARM_UP_TIMEOUT = 300     # Seconds allowed for loading the model at startup
+OLLAMA_NUM_CTX = 4096            # Context window every request loads the model with; Ollama reloads
+                                 # the model when a request asks for a different num_ctx
+OLLAMA_EMBED_MODEL = "nomic-embed-text"  # Embedding model for the semantic answer cache
+OLLAMA_EMBED_TIMEOUT = 10                # Seconds allowed for one embedding
 GEMINI_API_KEY = ""  # Replace with your actual API key
+GEMINI_MODEL = "gemini-1.5-flash"
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+
+# Shared HTTP session: keep-alive connections per backend, retry policy and concurrency limits
+HTTP_POOL_SIZE = {"ollama": 8, "gemini": 4}         # Idle keep-alive connections kept per host
+HTTP_RETRIES = 2                                    # Retries on connection errors and 502/503/504
+HTTP_BACKOFF = 0.3                                  # Seconds; doubled for each further retry
+BACKEND_MAX_CONCURRENT = {"ollama": 4, "gemini": 2}  # Requests allowed in flight per backend
+
+# Circuit breakers and adaptive timeouts, per backend
+BREAKER_FAILURES = 3        # Consecutive failures that open a backend's circuit
+BREAKER_OPEN_SECONDS = 30   # Requests fail fast this long before one probe request is let through
+TIMEOUT_CONNECT = 5         # Seconds to establish a connection
+TIMEOUT_DEFAULT = 60        # Seconds to wait for data until enough latencies have been observed
+TIMEOUT_MIN = 10            # Bounds of the adaptive read timeout
+TIMEOUT_MAX = 120
+TIMEOUT_MULTIPLIER = 3      # Read timeout = this * the p95 first-token latency
+TIMEOUT_MIN_SAMPLES = 10    # Latencies needed before the timeout adapts
 
-def ask_ai(prompt, model="ollama"):
+# Load balancing across OLLAMA_HOSTS
+LB_STRATEGY = "least_outstanding"  # or "latency": weigh outstanding requests by each host's latency
+LB_MAX_FAILURES = 3                # Consecutive failures before a host is ejected
+LB_SLOW_SECONDS = 15.0             # Hosts whose smoothed first-token latency exceeds this are ejected
+LB_EJECT_SECONDS = 30              # Minimum time an ejected host sits out before it is re-checked
+LB_HEALTH_INTERVAL = 10            # Seconds between background health checks
+LB_FAILURE_PENALTY = 2             # Outstanding requests each consecutive failure on a host counts as
+
+# Routing for model="auto": hedge and fail over between backends
+DEFAULT_MODEL = "auto"      # Backend used by AIWorker
+ROUTE_PRIMARY = "ollama"
+ROUTE_ALTERNATE = "gemini"  # Only used when it is configured (see _backend_available)
+ROUTE_HEDGE_AFTER = 2.0     # Seconds without a first token before the alternate is asked as well
+
+# Multi-turn conversations
+CONVERSATION_MAX_TOKENS = 3000  # Context size (Ollama tokens, or estimated transcript tokens) before summarizing
+CONVERSATION_KEEP_TURNS = 1     # Most recent turns kept verbatim next to the summary
+
+# Request priorities: lower is served first when a backend's slots are all taken
+PRIORITY_INTERACTIVE = 0  # Free chat the student is waiting on
+PRIORITY_COURSE = 1       # Curriculum topic explanations
+PRIORITY_BACKGROUND = 2   # Pre-generation and cache warming; preempted by the others
+
+# Ends an answer that broke off part way, set apart from the text already shown
+INTERRUPTED_NOTICE = "\n\n[The answer was interrupted. Please ask again.]"
+
+_session = None
+_session_lock = threading.Lock()
+_backend_slots = {}
+
+def configure_http(pool_size=None, retries=None, backoff=None, max_concurrent=None):
     """
-    Sends the user's prompt to the specified AI model (Ollama or Gemini) and aggregates the response.
+    Changes the connection pool size, retry policy or per-backend concurrency limits
+    (dicts are merged per backend). The shared session is rebuilt on next use.
+    """
+    global _session, HTTP_RETRIES, HTTP_BACKOFF
+    with _session_lock:
+        if pool_size:
+            HTTP_POOL_SIZE.update(pool_size)
+        if retries is not None:
+            HTTP_RETRIES = retries
+        if backoff is not None:
+            HTTP_BACKOFF = backoff
+        if max_concurrent:
+            BACKEND_MAX_CONCURRENT.update(max_concurrent)
+            _backend_slots.clear()
+        if _session is not None:
+            _session.close()
+            _session = None
+
+_sending = threading.local()  # The CancelToken (and its abort callbacks) of the request this thread is sending
+
+class _AbortableConnection:
+    """
+    Mixin for urllib3 connections: while a request is sent inside _abortable(cancel), firing
+    'cancel' shuts the socket down, so even a request still waiting for its response headers
+    (model load, prefill) ends at once.
+    """
+
+    def request(self, *args, **kwargs):
+        cancel = getattr(_sending, "cancel", None)
+        if cancel is not None:
+            _sending.aborts.append(self._abort)
+            cancel.add_callback(self._abort)
+        super().request(*args, **kwargs)
+        if cancel is not None and cancel.cancelled:
+            self._abort()  # Fired while the connection was still being opened
+
+    def _abort(self):
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class _AbortableHTTPConnection(_AbortableConnection, HTTPConnection):
+    pass
+
+class _AbortableHTTPSConnection(_AbortableConnection, HTTPSConnection):
+    pass
+
+class _AbortableHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _AbortableHTTPConnection
+
+class _AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _AbortableHTTPSConnection
+
+class _AbortableAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections can be aborted through _abortable()."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _AbortableHTTPConnectionPool,
+                                                   "https": _AbortableHTTPSConnectionPool}
+
+def _make_adapter(pool_size):
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,  # Never replay a generation that was already running
+        status=HTTP_RETRIES,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET", "POST"]),
+        backoff_factor=HTTP_BACKOFF,
+        raise_on_status=False,
+    )
+    return _AbortableAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+def get_session():
+    """Returns the long-lived requests.Session shared by every LLM call."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.mount("http://", _make_adapter(HTTP_POOL_SIZE["ollama"]))
+            session.mount("https://", _make_adapter(HTTP_POOL_SIZE["ollama"]))
+            session.mount(GEMINI_URL, _make_adapter(HTTP_POOL_SIZE["gemini"]))
+            _session = session
+        return _session
+
+def _backend_slot(backend):
+    """Returns the SlotScheduler limiting how many requests may be in flight to 'backend'."""
+    with _session_lock:
+        if backend not in _backend_slots:
+            _backend_slots[backend] = SlotScheduler(BACKEND_MAX_CONCURRENT[backend])
+        return _backend_slots[backend]
+
+class GenerationCancelled(Exception):
+    """Raised inside the streaming layers once a CancelToken has fired."""
+
+class GenerationPreempted(Exception):
+    """A background generation gave up its slot to a higher-priority request; retry it later."""
+
+class CancelToken:
+    """
+    Cancels a streaming generation from another thread: token delivery stops and the
+    HTTP response is closed at once, which unblocks the thread reading it.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.debug(f"Cancel callback failed: {e}")
+
+    def wait(self, timeout=None):
+        """Blocks until the token fires or 'timeout' seconds pass; True if it fired."""
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback):
+        """Registers 'callback' to run on cancel (immediately if already cancelled)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+class _SlotGrant:
+    """One request's claim on a backend slot, waiting or held."""
+
+    def __init__(self, priority, user, seq, cancel):
+        self.priority = priority
+        self.user = user
+        self.seq = seq
+        self.preempted = False
+        self.parent_cancel = cancel
+        self.cancel = CancelToken()  # Fires on the caller's cancel, or on preemption
+        if cancel:
+            cancel.add_callback(self.cancel.cancel)
+
+    def preempt(self):
+        self.preempted = True
+        self.cancel.cancel()
+
+    def detach(self):
+        if self.parent_cancel:
+            self.parent_cancel.remove_callback(self.cancel.cancel)
+
+class SlotScheduler:
+    """
+    Hands out a backend's 'capacity' concurrent slots by priority (PRIORITY_*), then to
+    the user with the fewest requests in flight and, among those, the one served least
+    recently (round robin), then first come first served. A waiting
+    interactive or course request preempts a running background one if no slot is free.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = []
+        self._active = []
+        self._user_active = {}
+        self._user_granted = {}  # user -> sequence number of their last grant
+        self._grants = itertools.count(1)
+        self.preemptions = 0
+
+    def _next(self):
+        return min(self._waiting, key=lambda g: (g.priority, self._user_active.get(g.user, 0),
+                                                 self._user_granted.get(g.user, 0), g.seq))
+
+    def _preempt_for(self, grant):
+        if grant.priority >= PRIORITY_BACKGROUND or len(self._active) < self.capacity:
+            return
+        victims = [g for g in self._active if g.priority >= PRIORITY_BACKGROUND and not g.preempted]
+        if victims:
+            victim = max(victims, key=lambda g: g.seq)  # The most recent one has the least work to lose
+            logging.info("Preempting a background generation for a higher-priority request")
+            self.preemptions += 1
+            victim.preempt()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, user=None, cancel=None):
+        """Blocks until a slot is granted and returns the grant; waiting can be cancelled."""
+        grant = _SlotGrant(priority, user, next(self._seq), cancel)
+        with self._cond:
+            self._waiting.append(grant)
+            self._preempt_for(grant)
+            while len(self._active) >= self.capacity or self._next() is not grant:
+                if cancel and cancel.cancelled:
+                    self._waiting.remove(grant)
+                    self._cond.notify_all()
+                    grant.detach()
+                    raise GenerationCancelled()
+                self._cond.wait(0.1)
+            self._waiting.remove(grant)
+            self._active.append(grant)
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+            self._user_granted[user] = next(self._grants)
+            self._cond.notify_all()
+        return grant
+
+    def release(self, grant):
+        grant.detach()
+        with self._cond:
+            self._active.remove(grant)
+            self._user_active[grant.user] -= 1
+            if not self._user_active[grant.user]:
+                del self._user_active[grant.user]
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "capacity": self.capacity,
+                "active": len(self._active),
+                "waiting": len(self._waiting),
+                "waiting_by_priority": {p: sum(1 for g in self._waiting if g.priority == p)
+                                        for p in (PRIORITY_INTERACTIVE, PRIORITY_COURSE, PRIORITY_BACKGROUND)},
+                "preemptions": self.preemptions,
+            }
+
+def scheduler_stats():
+    """Slot usage, queue lengths and preemptions for every backend that has been used."""
+    with _session_lock:
+        schedulers = dict(_backend_slots)
+    return {backend: scheduler.stats() for backend, scheduler in schedulers.items()}
+
+def _abort_response(response):
+    """
+    Closes a streaming response from another thread. Shutting the socket down first is
+    what wakes a reader blocked waiting for the next chunk.
+    """
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+@contextmanager
+def _held_slot(backend, cancel=None, meta=None, priority=PRIORITY_INTERACTIVE, user=None):
+    """
+    Holds one of 'backend's concurrency slots, granted by priority (see SlotScheduler);
+    waiting for it can be cancelled. Yields the CancelToken the request must use: it also
+    fires if the slot is preempted, which surfaces as GenerationPreempted.
+    The time spent waiting is stored as meta["queue_wait"].
+    """
+    scheduler = _backend_slot(backend)
+    started = time.perf_counter()
+    grant = scheduler.acquire(priority, user, cancel)
+    if meta is not None:
+        meta["queue_wait"] = time.perf_counter() - started
+    try:
+        yield grant.cancel
+    except GenerationCancelled:
+        if grant.preempted and not (cancel and cancel.cancelled):
+            raise GenerationPreempted(f"{backend} slot taken by a higher-priority request") from None
+        raise
+    finally:
+        scheduler.release(grant)
+
+@contextmanager
+def _abortable(cancel):
+    """
+    Lets 'cancel' abort the HTTP request sent inside the block before its response arrives
+    (see _AbortableConnection); the aborted request raises GenerationCancelled.
     """
-    if model.lower() == "ollama":
-        url = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}/api/generate"
-        payload = {
-            "model": "qwen2.5-coder:0.5b",
-            "prompt": prompt,
-            "stream": True  # Explicitly enable streaming
-        }
+    if cancel is None:
+        yield
+        return
+    if cancel.cancelled:
+        raise GenerationCancelled()
+    _sending.cancel, _sending.aborts = cancel, []
+    try:
+        yield
+    except requests.exceptions.RequestException:
+        if cancel.cancelled:
+            raise GenerationCancelled() from None
+        raise
+    finally:
+        for abort in _sending.aborts:
+            cancel.remove_callback(abort)
+        _sending.cancel, _sending.aborts = None, []
 
+@contextmanager
+def _open_stream(url, payload, cancel=None, meta=None, timeout=None):
+    """
+    Opens a streaming POST to 'url'. If 'cancel' fires, the request is aborted from the
+    cancelling thread, whether its response headers have arrived yet or not. The time
+    until the response headers arrived is stored as meta["connect"].
+    'timeout' is a requests (connect, read) timeout; see CircuitBreaker.timeout().
+    """
+    timeout = timeout or (TIMEOUT_CONNECT, TIMEOUT_DEFAULT)
+    with _abortable(cancel):
+        response = get_session().post(url, json=payload, timeout=timeout, stream=True)
+    with response:
+        if meta is not None:
+            meta["connect"] = response.elapsed.total_seconds()
+        if cancel:
+            abort = lambda: _abort_response(response)
+            cancel.add_callback(abort)
         try:
-            logging.debug(f"Sending request to Ollama: {url}")
-            response = requests.post(url, json=payload, timeout=60, stream=True)
             response.raise_for_status()
+            yield response
+        finally:
+            if cancel:
+                cancel.remove_callback(abort)
 
-            full_response = []
-            for chunk in response.iter_lines():
-                if chunk:
-                    try:
-                        chunk_data = json.loads(chunk.decode("utf-8"))
-                        if "response" in chunk_data:
-                            full_response.append(chunk_data["response"])
-                        if chunk_data.get("done", False):
-                            break
-                    except json.JSONDecodeError as e:
-                        logging.error(f"JSON decoding error: {e}")
-            
-            return ''.join(full_response).strip()
+class NDJSONDecoder:
+    """
+    Incremental newline-delimited JSON decoder working on raw bytes: feed() it network
+    chunks as they arrive and it returns the objects whose lines they complete. Lines are
+    parsed straight from bytes, without decoding to str first; malformed lines are logged
+    and skipped.
+    """
 
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Ollama error: {e}")
-            return "Error: Unable to process your request."
+    def __init__(self):
+        self._buffer = b""
 
-    elif model.lower() == "gemini":
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}"
-        payload = {
-            "contents": [{
-                "parts": [{"text": prompt}]
-            }]
-        }
+    def feed(self, data):
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split(b"\n")
+        self._buffer = lines.pop()
+        return [obj for obj in map(self._parse, lines) if obj is not None]
 
+    def close(self):
+        """Returns the object on a final line that had no trailing newline, if any."""
+        line, self._buffer = self._buffer, b""
+        obj = self._parse(line)
+        return [] if obj is None else [obj]
+
+    @staticmethod
+    def _parse(line):
+        if not line or line.isspace():
+            return None
         try:
-            logging.debug(f"Sending request to Gemini: {url}")
-            response = requests.post(url, json=payload, timeout=60)
+            return _json_loads(line)
+        except ValueError as e:  # json and orjson decode errors are both ValueErrors
+            logging.error(f"JSON decoding error: {e}")
+            return None
+
+def _iter_ndjson(response, cancel=None):
+    """
+    Yields the objects of a streaming NDJSON response as soon as their lines are complete,
+    ending with GenerationCancelled when 'cancel' closed the response. Ollama sends chunked
+    responses, so each read returns one HTTP chunk as soon as it arrives.
+    """
+    decoder = NDJSONDecoder()
+    try:
+        for data in response.iter_content(chunk_size=None):
+            if cancel and cancel.cancelled:
+                raise GenerationCancelled()
+            yield from decoder.feed(data)
+        yield from decoder.close()
+    except GenerationCancelled:
+        raise
+    except Exception:
+        if cancel and cancel.cancelled:
+            raise GenerationCancelled()
+        raise
+
+def _iter_lines(response, cancel=None):
+    """response.iter_lines(), ending with GenerationCancelled when 'cancel' closed the response."""
+    try:
+        for line in response.iter_lines():
+            if cancel and cancel.cancelled:
+                raise GenerationCancelled()
+            yield line
+    except GenerationCancelled:
+        raise
+    except Exception:
+        if cancel and cancel.cancelled:
+            raise GenerationCancelled()
+        raise
+
+class OllamaHost:
+    """Routing state for one Ollama server in the BackendPool."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.outstanding = 0      # Requests currently running on this host
+        self.latency = None       # Smoothed time to first token, in seconds
+        self.failures = 0         # Consecutive failures
+        self.ejected_at = None    # time.monotonic() of the ejection; None while in rotation
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def is_ejected(self):
+        return self.ejected_at is not None
+
+class BackendPool:
+    """
+    Spreads Ollama requests across several hosts. 'least_outstanding' picks the host with
+    the fewest running requests; 'latency' also weighs each host's smoothed first-token
+    latency. Hosts that fail repeatedly or turn slow are ejected until a health check
+    (GET /api/tags) finds them responsive again.
+    """
+
+    def __init__(self, hosts, strategy=None, max_failures=None, slow_seconds=None, eject_seconds=None,
+                 failure_penalty=None):
+        self.hosts = [OllamaHost(host, port) for host, port in hosts]
+        self.strategy = strategy or LB_STRATEGY
+        self.max_failures = max_failures or LB_MAX_FAILURES
+        self.slow_seconds = slow_seconds or LB_SLOW_SECONDS
+        self.eject_seconds = eject_seconds or LB_EJECT_SECONDS
+        self.failure_penalty = LB_FAILURE_PENALTY if failure_penalty is None else failure_penalty
+        self._lock = threading.Lock()
+        self._health_thread = None
+        self._stopped = threading.Event()
+
+    def _score(self, host, default_latency):
+        # A host that has not answered yet is assumed to be as fast as the others, and
+        # recent failures count as extra queued requests so a failing host loses its turn
+        latency = host.latency if host.latency is not None else default_latency
+        load = host.outstanding + self.failure_penalty * host.failures
+        if self.strategy == "latency":
+            # Expected wait: every queued request costs roughly one latency on this host
+            return (latency * (load + 1), load)
+        return (load, latency)
+
+    def acquire(self):
+        """Picks the host for the next request and counts it as outstanding there."""
+        with self._lock:
+            candidates = [h for h in self.hosts if not h.is_ejected()]
+            if candidates:
+                known = [h.latency for h in candidates if h.latency is not None]
+                default_latency = sum(known) / len(known) if known else 0.0
+                host = min(candidates, key=lambda h: self._score(h, default_latency))
+            else:
+                # Everything is ejected: fail open to the host ejected longest ago
+                host = min(self.hosts, key=lambda h: h.ejected_at)
+            host.outstanding += 1
+            host.requests += 1
+            return host
+
+    def release(self, host, latency=None, ok=True):
+        """Records how a request on 'host' went and ejects the host if it is failing or slow."""
+        with self._lock:
+            host.outstanding -= 1
+            if not ok:
+                host.errors += 1
+                host.failures += 1
+                if host.failures >= self.max_failures and not host.is_ejected():
+                    self._eject(host, f"{host.failures} consecutive failures")
+                return
+            host.failures = 0
+            if latency is not None:
+                host.latency = latency if host.latency is None else 0.7 * host.latency + 0.3 * latency
+                others = [h for h in self.hosts if h is not host and not h.is_ejected()]
+                if host.latency > self.slow_seconds and others and not host.is_ejected():
+                    self._eject(host, f"first-token latency {host.latency:.1f}s")
+
+    def has_healthy_host(self):
+        """True if some host is in rotation and its last request did not fail."""
+        with self._lock:
+            return any(not h.is_ejected() and not h.failures for h in self.hosts)
+
+    def _eject(self, host, reason):
+        host.ejected_at = time.monotonic()
+        logging.warning(f"Ejecting Ollama host {host.base_url}: {reason}")
+
+    def check_health(self, timeout=3):
+        """
+        Probes every host once. Unresponsive hosts are ejected; ejected hosts that answer
+        again and have sat out 'eject_seconds' are put back into rotation.
+        """
+        for host in self.hosts:
+            try:
+                get_session().get(f"{host.base_url}/api/tags", timeout=timeout).raise_for_status()
+                healthy = True
+            except requests.exceptions.RequestException:
+                healthy = False
+            with self._lock:
+                if not healthy:
+                    if not host.is_ejected():
+                        self._eject(host, "health check failed")
+                elif host.is_ejected() and time.monotonic() - host.ejected_at >= self.eject_seconds:
+                    logging.info(f"Ollama host {host.base_url} is back in rotation")
+                    host.ejected_at = None
+                    host.failures = 0
+                    host.latency = None  # Re-learn latency instead of ejecting again on stale data
+
+    def start_health_checks(self, interval=None):
+        """Runs check_health every 'interval' seconds on a daemon thread."""
+        if self._health_thread is not None:
+            return
+        interval = interval or LB_HEALTH_INTERVAL
+
+        def loop():
+            while not self._stopped.wait(interval):
+                self.check_health()
+
+        self._health_thread = threading.Thread(target=loop, name="OllamaHealthCheck", daemon=True)
+        self._health_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "host": h.base_url,
+                    "outstanding": h.outstanding,
+                    "latency": h.latency,
+                    "requests": h.requests,
+                    "errors": h.errors,
+                    "ejected": h.is_ejected(),
+                }
+                for h in self.hosts
+            ]
+
+_pool = None
+_pool_hosts = None
+
+def _configured_hosts():
+    return [tuple(h) for h in OLLAMA_HOSTS] or [(OLLAMA_HOST, OLLAMA_PORT)]
+
+def get_backend_pool():
+    """Returns the BackendPool for the configured hosts (rebuilt if the configuration changed)."""
+    global _pool, _pool_hosts
+    hosts = _configured_hosts()
+    with _session_lock:
+        if _pool is None or hosts != _pool_hosts:
+            if _pool is not None:
+                _pool.stop()
+            _pool = BackendPool(hosts)
+            _pool_hosts = hosts
+            if len(hosts) > 1:
+                _pool.start_health_checks()
+        return _pool
+
+def in_class_hours():
+    """True during OLLAMA_CLASS_HOURS (local time)."""
+    return bool(OLLAMA_CLASS_HOURS) and OLLAMA_CLASS_HOURS[0] <= time.localtime().tm_hour < OLLAMA_CLASS_HOURS[1]
+
+def current_keep_alive():
+    """The keep_alive sent with Ollama requests: longer during class hours, shorter otherwise."""
+    return OLLAMA_CLASS_KEEP_ALIVE if in_class_hours() else OLLAMA_KEEP_ALIVE
+
+def warm_up_model(model=None, keep_alive=None):
+    """
+    Loads the Ollama model into memory on every host (a generate request without a prompt)
+    so the first question does not pay the model load. Returns True if all hosts are ready.
+    """
+    payload = {
+        "model": model or OLLAMA_MODEL,
+        "keep_alive": keep_alive or current_keep_alive(),
+        "options": {"num_ctx": OLLAMA_NUM_CTX},  # Load with the context size requests will use
+        "stream": False
+    }
+    ready = True
+    for host in get_backend_pool().hosts:
+        started = time.perf_counter()
+        try:
+            # Takes a background slot like any other request, so a student's question is never queued behind it
+            with _held_slot("ollama", priority=PRIORITY_BACKGROUND) as cancel, _abortable(cancel):
+                response = get_session().post(f"{host.base_url}/api/generate", json=payload,
+                                              timeout=OLLAMA_WARM_UP_TIMEOUT)
             response.raise_for_status()
-            response_data = response.json()
-            
+        except GenerationPreempted:
+            logging.info(f"Ollama warm-up on {host.base_url} gave way to a student's request")
+            continue
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Ollama warm-up failed on {host.base_url}: {e}")
+            ready = False
+            continue
+        logging.info(f"Ollama model '{payload['model']}' loaded on {host.base_url} "
+                     f"in {time.perf_counter() - started:.1f}s")
+    return ready
+
+def start_warm_up(model=None, keep_alive=None):
+    """Runs warm_up_model on a background thread and returns the thread."""
+    thread = threading.Thread(target=warm_up_model, args=(model, keep_alive), name="OllamaWarmUp", daemon=True)
+    thread.start()
+    return thread
+
+def release_model(model=None, force=False):
+    """
+    Asks Ollama to unload the model right away (keep_alive 0), e.g. when the app closes.
+    Unless 'force' is set, this only happens with OLLAMA_RELEASE_ON_EXIT and outside class
+    hours: the model is shared, and keep_alive releases it once nobody is using it.
+    Returns True if the unload was requested.
+    """
+    if not force and (not OLLAMA_RELEASE_ON_EXIT or in_class_hours()):
+        logging.debug("Leaving the Ollama model loaded; keep_alive will release it.")
+        return False
+    payload = {"model": model or OLLAMA_MODEL, "keep_alive": 0, "stream": False}
+    for host in get_backend_pool().hosts:
+        try:
+            get_session().post(f"{host.base_url}/api/generate", json=payload, timeout=5).raise_for_status()
+            logging.debug(f"Ollama model '{payload['model']}' released on {host.base_url}.")
+        except requests.exceptions.RequestException as e:
+            logging.debug(f"Ollama release failed on {host.base_url}: {e}")
+    return True
+
+def embed(text, model=None, cancel=None):
+    """
+    Returns Ollama's embedding vector (a list of floats) for 'text'. Raises on failure, or
+    GenerationCancelled if 'cancel' fired meanwhile.
+    """
+    pool = get_backend_pool()
+    host = pool.acquire()
+    payload = {"model": model or OLLAMA_EMBED_MODEL, "prompt": text, "keep_alive": current_keep_alive()}
+    try:
+        with _abortable(cancel):
+            response = get_session().post(f"{host.base_url}/api/embeddings", json=payload,
+                                          timeout=OLLAMA_EMBED_TIMEOUT)
+        response.raise_for_status()
+        vector = response.json()["embedding"]
+    except requests.exceptions.HTTPError:
+        # The host answered (e.g. 404 for a model that isn't pulled): not a sign it is unhealthy
+        pool.release(host)
+        raise
+    except requests.exceptions.RequestException:
+        pool.release(host, ok=False)
+        raise
+    except BaseException:
+        pool.release(host)
+        raise
+    pool.release(host)
+    return vector
+
+# Statistics Ollama reports in the final ("done") chunk of a generation
+OLLAMA_DONE_FIELDS = ("context", "total_duration", "load_duration", "prompt_eval_count",
+                      "prompt_eval_duration", "eval_count", "eval_duration")
+
+def _stream_ollama(prompt, cancel=None, meta=None, context=None, system=None, options=None,
+                   priority=PRIORITY_INTERACTIVE, user=None, timeout=None):
+    """
+    Yields response pieces from Ollama's streaming /api/generate endpoint on the least busy host.
+    'context' continues a previous generation; 'system' is sent in Ollama's system field;
+    'options' are Ollama generation options (num_predict, temperature, ...);
+    'meta' receives the final chunk's statistics.
+    'priority' and 'user' decide when the request gets a slot (see SlotScheduler).
+    """
+    with _held_slot("ollama", cancel, meta, priority, user) as cancel:
+        yield from _stream_ollama_host(prompt, cancel, meta, context, system, options, timeout)
+
+def _stream_ollama_host(prompt, cancel=None, meta=None, context=None, system=None, options=None, timeout=None):
+    pool = get_backend_pool()
+    host = pool.acquire()
+    url = f"{host.base_url}/api/generate"
+    payload = {
+        "model": OLLAMA_MODEL,
+        "prompt": prompt,
+        "keep_alive": current_keep_alive(),
+        "options": {"num_ctx": OLLAMA_NUM_CTX, **(options or {})},
+        "stream": True  # Explicitly enable streaming
+    }
+    if context:
+        payload["context"] = context
+    if system:
+        payload["system"] = system
+    if meta is not None:
+        meta["backend"] = "ollama"
+        meta["host"] = host.base_url
+
+    logging.debug(f"Sending request to Ollama: {url}")
+    started = time.perf_counter()
+    first_token = None
+    try:
+        with _open_stream(url, payload, cancel, meta, timeout) as response:
+            # Read to the end of the body (past the "done" chunk) so the connection goes back to the pool
+            for chunk_data in _iter_ndjson(response, cancel):
+                piece = chunk_data.get("response")
+                if piece:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    yield piece
+                if chunk_data.get("done") and meta is not None:
+                    meta.update({k: chunk_data[k] for k in OLLAMA_DONE_FIELDS if k in chunk_data})
+    except requests.exceptions.RequestException:
+        pool.release(host, ok=False)
+        raise
+    except BaseException:
+        pool.release(host)  # Cancelled or abandoned: says nothing about the host's health
+        raise
+    pool.release(host, latency=first_token)
+
+def _stream_gemini(prompt, cancel=None, meta=None, context=None, system=None, options=None,
+                   priority=PRIORITY_INTERACTIVE, user=None, timeout=None):
+    """
+    Yields response pieces from Gemini's server-sent-events streaming endpoint.
+    Gemini has no equivalent of Ollama's 'context', so it is ignored; of the Ollama
+    'options', num_predict and temperature are translated.
+    """
+    url = f"{GEMINI_URL}/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+    payload = {
+        "contents": [{
+            "parts": [{"text": prompt}]
+        }]
+    }
+    if system:
+        payload["systemInstruction"] = {"parts": [{"text": system}]}
+    if options:
+        config = {"maxOutputTokens": options.get("num_predict"), "temperature": options.get("temperature")}
+        config = {k: v for k, v in config.items() if v is not None}
+        if config:
+            payload["generationConfig"] = config
+
+    if meta is not None:
+        meta["backend"] = "gemini"
+    logging.debug(f"Sending request to Gemini: {url}")
+    with _held_slot("gemini", cancel, meta, priority, user) as cancel, \
+            _open_stream(url, payload, cancel, meta, timeout) as response:
+        for line in _iter_lines(response, cancel):
+            if not line.startswith(b"data:"):
+                continue
+            try:
+                response_data = _json_loads(line[len(b"data:"):])
+            except ValueError as e:
+                logging.error(f"JSON decoding error: {e}")
+                continue
+
+            if "usageMetadata" in response_data and meta is not None:
+                usage = response_data["usageMetadata"]
+                meta["eval_count"] = usage.get("candidatesTokenCount")
+                meta["prompt_eval_count"] = usage.get("promptTokenCount")
+
             # Parse Gemini response
             if "candidates" in response_data:
-                return response_data["candidates"][0]["content"]["parts"][0]["text"].strip()
+                for part in response_data["candidates"][0].get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
             else:
                 logging.error(f"Unexpected Gemini response: {json.dumps(response_data, indent=2)}")
-                return "Error: Unexpected response format from Gemini."
 
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Gemini error: {str(e)}")
-            if hasattr(e, 'response') and e.response:
-                logging.error(f"Response content: {e.response.text}")
-            return "Error: Unable to process your request."
+def _backend_available(backend):
+    return backend == "ollama" or (backend == "gemini" and bool(GEMINI_API_KEY))
+
+def _may_leave_ollama(model):
+    """True if a request to 'model' may be answered by a backend other than Ollama."""
+    if model == "auto":
+        return any(backend != "ollama" and _backend_available(backend)
+                   for backend in (ROUTE_PRIMARY, ROUTE_ALTERNATE))
+    return model != "ollama"
+
+def _stream_routed(prompt, cancel=None, meta=None, primary=None, alternate=None, hedge_after=None, **params):
+    """
+    Streams from the primary backend. If it has produced no token after 'hedge_after'
+    seconds, or fails before its first token, the alternate backend is asked too. The
+    first backend to produce a token wins and the other request is cancelled.
+    """
+    primary = primary or ROUTE_PRIMARY
+    alternate = alternate or ROUTE_ALTERNATE
+    hedge_after = ROUTE_HEDGE_AFTER if hedge_after is None else hedge_after
+    if not _backend_available(alternate) or alternate == primary:
+        yield from _BACKENDS[primary](prompt, cancel=cancel, meta=meta, **params)
+        return
+
+    events = queue.Queue()
+    racers = {}  # backend -> CancelToken of its request
+    racer_meta = {}
+
+    def start(backend):
+        token = CancelToken()
+        racers[backend] = token
+        racer_meta[backend] = {}
+
+        def run():
+            try:
+                for piece in _BACKENDS[backend](prompt, cancel=token, meta=racer_meta[backend], **params):
+                    events.put((backend, "piece", piece))
+                events.put((backend, "done", None))
+            except GenerationCancelled:
+                events.put((backend, "cancelled", None))
+            except Exception as e:
+                events.put((backend, "error", e))
+
+        threading.Thread(target=run, name=f"Route-{backend}", daemon=True).start()
+
+    def cancel_all():
+        for token in list(racers.values()):
+            token.cancel()
+
+    if cancel:
+        cancel.add_callback(cancel_all)
+    start(primary)
+    deadline = time.monotonic() + hedge_after
+    winner = None
+    failed = set()
+    try:
+        while True:
+            timeout = None
+            if winner is None and alternate not in racers:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                backend, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                logging.info(f"No first token from {primary} after {hedge_after}s; hedging with {alternate}")
+                start(alternate)
+                continue
+
+            if winner is not None and backend != winner:
+                continue  # Leftovers from the losing request
+            if kind == "piece":
+                if winner is None:
+                    winner = backend
+                    logging.debug(f"{backend} produced the first token; cancelling the other request")
+                    for other, token in racers.items():
+                        if other != backend:
+                            token.cancel()
+                yield value
+            elif kind == "done":
+                if meta is not None:
+                    meta.update(racer_meta[backend])
+                    meta["hedged"] = len(racers) > 1
+                return
+            elif kind == "cancelled":
+                if cancel and cancel.cancelled:
+                    raise GenerationCancelled()
+            elif kind == "error":
+                if backend == winner:
+                    raise value  # Failed mid-answer: nothing left to fail over to cleanly
+                failed.add(backend)
+                if alternate not in racers:
+                    logging.warning(f"{backend} failed before its first token ({value}); failing over to {alternate}")
+                    start(alternate)
+                elif failed == set(racers):
+                    raise value
+    finally:
+        cancel_all()
+        if cancel:
+            cancel.remove_callback(cancel_all)
+
+def _model_name(backend):
+    if backend == "auto":
+        return f"{OLLAMA_MODEL}|{GEMINI_MODEL}" if _backend_available("gemini") else OLLAMA_MODEL
+    return OLLAMA_MODEL if backend == "ollama" else GEMINI_MODEL
 
+def _log_backend_error(backend, e):
+    if backend == "ollama":
+        logging.error(f"Ollama error: {e}")
+    elif backend == "auto":
+        logging.error(f"All backends failed: {e}")
     else:
-        return "Error: Unsupported model. Choose 'ollama' or 'gemini'."
+        logging.error(f"Gemini error: {str(e)}")
+        if hasattr(e, 'response') and e.response is not None:
+            logging.error(f"Response content: {e.response.text}")
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised without contacting a backend whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """
+    Tracks one backend's health. After BREAKER_FAILURES consecutive failures the circuit
+    opens and requests fail immediately; after BREAKER_OPEN_SECONDS a single probe request
+    is let through (half open), and its outcome closes or re-opens the circuit.
+    Also derives the backend's read timeout from recent first-token latencies.
+    """
+
+    def __init__(self, backend, failures=BREAKER_FAILURES, open_seconds=BREAKER_OPEN_SECONDS):
+        self.backend = backend
+        self.max_failures = failures
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._probing = False
+        self._latencies = collections.deque(maxlen=200)
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        """Raises CircuitOpenError if the backend should not be contacted right now."""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "closed":
+                return
+            if self.state == "half_open" and not self._probing:
+                self._probing = True  # This request is the probe
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.backend} circuit is open after repeated failures")
+
+    def record_success(self, latency=None):
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"{self.backend} recovered; closing its circuit")
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+            if latency is not None:
+                self._latencies.append(latency)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.max_failures):
+                logging.warning(f"Opening the {self.backend} circuit for {self.open_seconds}s "
+                                f"after {self.failures} consecutive failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trips += 1
+
+    def record_abandoned(self):
+        """The request was cancelled or preempted: says nothing about the backend's health."""
+        with self._lock:
+            self._probing = False
+
+    def timeout(self):
+        """(connect, read) timeout: TIMEOUT_MULTIPLIER x the p95 first-token latency, within bounds."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < TIMEOUT_MIN_SAMPLES:
+            return TIMEOUT_CONNECT, TIMEOUT_DEFAULT
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        return TIMEOUT_CONNECT, min(TIMEOUT_MAX, max(TIMEOUT_MIN, p95 * TIMEOUT_MULTIPLIER))
+
+    def stats(self):
+        with self._lock:
+            state, failures, trips, rejected = self.state, self.failures, self.trips, self.rejected
+        return {"state": state, "failures": failures, "trips": trips, "rejected": rejected,
+                "read_timeout": self.timeout()[1]}
+
+_breakers = {}
+
+def get_breaker(backend):
+    """Returns the CircuitBreaker of 'backend' ("ollama" or "gemini")."""
+    with _session_lock:
+        if backend not in _breakers:
+            _breakers[backend] = CircuitBreaker(backend)
+        return _breakers[backend]
+
+def breaker_stats():
+    with _session_lock:
+        breakers = dict(_breakers)
+    return {backend: breaker.stats() for backend, breaker in breakers.items()}
+
+def record_backend_failure(backend):
+    """
+    Counts a failed request against 'backend''s CircuitBreaker. A single Ollama host failing
+    is left to the BackendPool, which ejects it; the "ollama" circuit only counts failures
+    once no host in the pool is healthy, so one bad box can't cut off the others.
+    """
+    breaker = get_breaker(backend)
+    if backend == "ollama" and get_backend_pool().has_healthy_host():
+        breaker.record_abandoned()
+    else:
+        breaker.record_failure()
+
+def _guarded(backend, stream):
+    """
+    Wraps a backend's stream function with its CircuitBreaker: fails fast while the circuit
+    is open, applies the adaptive timeout and reports each request's outcome (failures
+    through record_backend_failure).
+    """
+    def guarded(prompt, cancel=None, meta=None, **params):
+        breaker = get_breaker(backend)
+        breaker.before_request()
+        meta = {} if meta is None else meta
+        started = time.perf_counter()
+        latency = None
+        try:
+            for piece in stream(prompt, cancel=cancel, meta=meta, timeout=breaker.timeout(), **params):
+                if latency is None:
+                    latency = time.perf_counter() - started - meta.get("queue_wait", 0.0)
+                yield piece
+        except requests.exceptions.RequestException:
+            record_backend_failure(backend)
+            raise
+        except BaseException:
+            breaker.record_abandoned()
+            raise
+        breaker.record_success(latency)
+    return guarded
+
+_BACKENDS = {
+    "ollama": _guarded("ollama", _stream_ollama),
+    "gemini": _guarded("gemini", _stream_gemini),
+    "auto": _stream_routed,
+}
+
+class PrefillTracker:
+    """
+    Measures how much prompt prefill Ollama took from its prefix cache (a system prompt it
+    saw before, or a conversation's carried context) instead of evaluating it again, from
+    Ollama's own counts: the 'context' it returns holds every prompt and answer token, so
+    len(context) - eval_count is the full prompt, and whatever prompt_eval_count did not
+    evaluate of it came from the prefix cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._systems = set()  # Distinct system prompts seen
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.evaluated_tokens = 0
+        self.reused_tokens = 0
+        self.prefill_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def record(self, system, meta):
+        evaluated = meta.get("prompt_eval_count") or 0
+        seconds = (meta.get("prompt_eval_duration") or 0) / 1e9
+        context = meta.get("context")
+        with self._lock:
+            self._systems.add(system)
+            self.requests += 1
+            self.evaluated_tokens += evaluated
+            self.prefill_seconds += seconds
+            if not context:
+                return  # No full prompt length to compare against (e.g. Gemini)
+            prompt_tokens = max(len(context) - (meta.get("eval_count") or 0), evaluated)
+            self.prompt_tokens += prompt_tokens
+            reused = prompt_tokens - evaluated
+            if reused and evaluated:
+                self.reused_tokens += reused
+                self.saved_seconds += reused * seconds / evaluated
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "system_prefixes": len(self._systems),
+                "prompt_tokens": self.prompt_tokens,
+                "evaluated_tokens": self.evaluated_tokens,
+                "reused_tokens": self.reused_tokens,
+                "prefill_seconds": self.prefill_seconds,
+                "saved_seconds": self.saved_seconds,
+            }
+
+_prefill = PrefillTracker()
+
+def prefill_stats():
+    """Prompt tokens evaluated vs. reused from Ollama's prefix cache, and the estimated time saved."""
+    return _prefill.stats()
+
+class _Flight:
+    """One upstream generation whose pieces are replayed to every subscriber."""
+
+    def __init__(self):
+        self.pieces = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cond = threading.Condition()
+        self.upstream_cancel = CancelToken()  # Fired when the last subscriber leaves
+        self.meta = {}
+
+_flights = {}  # request key -> _Flight currently generating
+_flights_lock = threading.Lock()
+
+def _pump_flight(key, flight, backend, prompt, params):
+    """Runs the upstream generation for 'flight' on its own thread."""
+    try:
+        for piece in _BACKENDS[backend](prompt, cancel=flight.upstream_cancel, meta=flight.meta, **params):
+            with flight.cond:
+                flight.pieces.append(piece)
+                flight.cond.notify_all()
+    except GenerationCancelled as e:
+        logging.debug("All subscribers left; abandoned shared generation.")
+        flight.error = e  # The text is cut off: nobody may take it for a complete answer
+    except Exception as e:
+        flight.error = e
+    finally:
+        with _flights_lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+        with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+
+def _stream_coalesced(key, backend, prompt, cancel=None, meta=None, **params):
+    """
+    Yields the pieces of the generation for 'key', joining an identical request that is
+    already in flight instead of starting a second one upstream. Cancelling only detaches
+    this subscriber; the upstream request stops once no subscriber is left.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _flights[key] = flight
+        with flight.cond:
+            flight.subscribers += 1
+
+    if leader:
+        threading.Thread(target=_pump_flight, args=(key, flight, backend, prompt, params), daemon=True).start()
+    else:
+        logging.debug("Joining an identical in-flight generation.")
+
+    def wake():
+        with flight.cond:
+            flight.cond.notify_all()
+
+    if cancel:
+        cancel.add_callback(wake)
+    index = 0
+    try:
+        while True:
+            with flight.cond:
+                while index >= len(flight.pieces) and not flight.done:
+                    if cancel and cancel.cancelled:
+                        raise GenerationCancelled()
+                    flight.cond.wait()
+                pieces = flight.pieces[index:]
+                index = len(flight.pieces)
+                done, error = flight.done, flight.error
+            yield from pieces
+            if done:
+                if error:
+                    raise error
+                if meta is not None:
+                    meta.update(flight.meta)
+                    meta["coalesced"] = not leader
+                return
+    finally:
+        if cancel:
+            cancel.remove_callback(wake)
+        with _flights_lock:
+            with flight.cond:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+            if abandoned and _flights.get(key) is flight:
+                # In the same step, so an identical request arriving now starts a fresh generation
+                del _flights[key]
+        if abandoned:
+            flight.upstream_cancel.cancel()
+
+def stream_ai(prompt, model="ollama", use_cache=False, raise_errors=False, coalesce=True, cancel=None,
+              context=None, meta=None, system=None, options=None, priority=PRIORITY_INTERACTIVE, user=None):
+    """
+    Sends the user's prompt to the specified AI model (Ollama or Gemini) and yields
+    the response text piece by piece as it is generated. "auto" routes between them
+    (see _stream_routed): hedged after ROUTE_HEDGE_AFTER seconds and failing over on errors.
+    Errors are logged and yielded as a final "Error: ..." piece, like ask_ai returns them;
+    if the answer had already started, that piece is INTERRUPTED_NOTICE instead.
+    With 'use_cache', a previously completed answer to the same prompt is returned at once,
+    and a newly completed answer is stored for next time.
+    With 'raise_errors', request failures propagate instead (for batch jobs that must not
+    store error text).
+    With 'coalesce', concurrent identical requests share a single upstream generation.
+    Firing the CancelToken 'cancel' ends the stream early and closes the HTTP response.
+    'context' is the array Ollama returned for the previous turn of a conversation; the dict
+    'meta' is filled with details of the generation (backend, Ollama's final statistics
+    including the new 'context', and "error" if it failed). Every call's timings and token
+    counts are also recorded by llm_metrics.get_metrics_recorder().
+    'system' carries fixed instructions separately from the variable 'prompt'; keeping it
+    identical across requests lets Ollama reuse its prefill (see prefill_stats()).
+    'options' are Ollama generation options such as num_predict and temperature
+    (see course_data.generation_options()).
+    Backends that keep failing are skipped for a while (see CircuitBreaker); failed requests
+    then fall back to a cached answer for the same prompt when there is one.
+    'priority' (PRIORITY_*) and 'user' order requests waiting for a backend slot. A
+    PRIORITY_BACKGROUND generation may be preempted: it then raises GenerationPreempted
+    with 'raise_errors', or ends with a notice piece.
+    """
+    backend = model.lower()
+    if backend not in _BACKENDS:
+        if raise_errors:
+            raise ValueError(f"Unsupported model: {model}")
+        yield "Error: Unsupported model. Choose 'ollama', 'gemini' or 'auto'."
+        return
+
+    request = _AIRequest(backend, prompt, use_cache, raise_errors, meta, priority,
+                         context=context, system=system, options=options)
+    try:
+        cached = request.cached()
+        if cached is not None:
+            yield cached
+            return
+
+        if cancel and cancel.cancelled:
+            request.status = "cancelled"
+            return
+
+        schedule = {"priority": priority, "user": user}
+        if coalesce:
+            # Requests of different priority don't share a generation: a background one may be preempted
+            upstream = _stream_coalesced((request.key, priority), backend, prompt, cancel=cancel, meta=request.meta,
+                                         **request.params, **schedule)
+        else:
+            upstream = _BACKENDS[backend](prompt, cancel=cancel, meta=request.meta, **request.params, **schedule)
+        for piece in upstream:
+            if cancel and cancel.cancelled:
+                raise GenerationCancelled()
+            request.piece(piece)
+            yield piece
+    except GeneratorExit:
+        request.cancelled()
+        raise
+    except GenerationCancelled:
+        request.cancelled(own=bool(cancel and cancel.cancelled))
+        return
+    except GenerationPreempted as e:
+        notice = request.preempted(e)
+        if raise_errors:
+            raise
+        yield notice
+        return
+    except requests.exceptions.RequestException as e:
+        notice = request.failed(e)
+        if raise_errors:
+            raise
+        yield notice
+        return
+    finally:
+        request.record()
+    request.finish()
+
+class _AIRequest:
+    """
+    The backend-independent steps of one request: response cache lookup and store, the
+    notice or cached fallback shown on errors, metrics and prefill statistics. stream_ai
+    and ollama_async.AsyncLLMClient.stream both drive one of these around their own
+    transport, so the two paths follow the same rules. Call cached() first, piece() for
+    every piece received, one of cancelled()/preempted()/failed() if the request ended
+    early, record() in any case and finish() after a complete answer.
+    """
+
+    def __init__(self, backend, prompt, use_cache, raise_errors, meta, priority,
+                 context=None, system=None, options=None):
+        self.backend = backend
+        self.system = system
+        self.raise_errors = raise_errors
+        self.params = {name: value for name, value in (("context", context), ("system", system),
+                                                       ("options", options)) if value}
+        self.key = make_cache_key(backend, _model_name(backend), prompt, self.params)
+        self.cache = get_response_cache() if use_cache else None
+        self.meta = {} if meta is None else meta
+        self.meta["cache"] = "miss" if self.cache else "off"
+        self.meta["priority"] = priority
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.status = "ok"
+        self.pieces = []
+
+    def cached(self):
+        """The stored answer when the cache is used and has one, else None."""
+        if not self.cache:
+            return None
+        cached = self.cache.get(self.key)
+        if cached is not None:
+            logging.debug(f"LLM cache hit ({self.cache.hits} hits / {self.cache.misses} misses)")
+            self.meta["cache"] = "hit"
+            self.first_token = time.perf_counter() - self.started
+        return cached
+
+    def piece(self, piece):
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.started
+        self.pieces.append(piece)
+
+    def cancelled(self, own=True):
+        """The request stopped early; unless the caller cancelled it ('own'), that is an error."""
+        self.status = "cancelled"
+        logging.debug("Generation cancelled.")
+        if not own:
+            self.meta["error"] = "The shared generation was abandoned"
+
+    def preempted(self, e):
+        """Returns the notice to show for a preempted background generation."""
+        self.status = "preempted"
+        logging.debug(f"Generation preempted: {e}")
+        self.meta["error"] = str(e)
+        if self.pieces:
+            return INTERRUPTED_NOTICE
+        return "Error: The tutor is busy with other questions; please try again."
+
+    def failed(self, e):
+        """
+        Records the failure 'e' and returns what to show instead: a stored answer for the
+        same prompt if there is one, else an error notice (None with 'raise_errors'). After
+        part of the answer was yielded, the notice is INTERRUPTED_NOTICE, which starts on a
+        line of its own instead of running on from the partial text.
+        """
+        self.status = "error"
+        if isinstance(e, CircuitOpenError):
+            logging.debug(str(e))
+        else:
+            _log_backend_error(self.backend, e)
+        self.meta["error"] = str(e) or type(e).__name__
+        if self.raise_errors:
+            return None
+        if self.pieces:
+            return INTERRUPTED_NOTICE
+        fallback = get_response_cache().get(self.key)
+        if fallback is not None:
+            # A stored answer (even one this request didn't ask the cache for) beats an error
+            self.meta["cache"] = "fallback"
+            return fallback
+        if isinstance(e, CircuitOpenError):
+            return "Error: The AI tutor is not responding right now. Please try again in a minute."
+        return "Error: Unable to process your request."
+
+    def record(self):
+        _record_metrics(self.backend, self.meta, self.status, self.first_token, time.perf_counter() - self.started)
+
+    def finish(self):
+        """After a complete answer: prefill statistics, and the answer goes into the cache."""
+        if self.system and "prompt_eval_count" in self.meta:
+            _prefill.record(self.system, self.meta)
+        if self.cache and self.pieces:
+            self.cache.put(self.key, ''.join(self.pieces).strip(), backend=self.backend,
+                           model=_model_name(self.backend))
+
+def _record_metrics(backend, meta, status, first_token, total):
+    """Sends one request's timings and token counts (see llm_metrics) to the metrics sink."""
+    tokens = meta.get("eval_count")
+    tokens_per_second = None
+    if tokens and meta.get("eval_duration"):
+        tokens_per_second = tokens / (meta["eval_duration"] / 1e9)
+    elif tokens and first_token is not None and total > first_token:
+        tokens_per_second = tokens / (total - first_token)  # Gemini reports no generation time
+    get_metrics_recorder().record({
+        "backend": meta.get("backend", backend),
+        "host": meta.get("host"),
+        "cache": meta["cache"],
+        "priority": meta["priority"],
+        "coalesced": meta.get("coalesced", False),
+        "hedged": meta.get("hedged", False),
+        "status": status,
+        "queue_wait": meta.get("queue_wait"),
+        "connect": meta.get("connect"),
+        "ttft": first_token,
+        "total": total,
+        "tokens": tokens,
+        "tokens_per_second": tokens_per_second,
+        "prompt_tokens": meta.get("prompt_eval_count"),
+    })
+
+def ask_ai(prompt, model="ollama", on_token=None, use_cache=False, raise_errors=False, coalesce=True,
+           cancel=None, context=None, meta=None, system=None, options=None, priority=PRIORITY_INTERACTIVE,
+           user=None):
+    """
+    Sends the user's prompt to the specified AI model (Ollama or Gemini) and aggregates the response.
+    If 'on_token' is given it is called with each piece of text as soon as it arrives.
+    If 'cancel' fires, the text received so far is returned.
+    """
+    full_response = []
+    for piece in stream_ai(prompt, model=model, use_cache=use_cache, raise_errors=raise_errors,
+                           coalesce=coalesce, cancel=cancel, context=context, meta=meta, system=system,
+                           options=options, priority=priority, user=user):
+        full_response.append(piece)
+        if on_token:
+            on_token(piece)
+    return ''.join(full_response).strip()
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) for budgeting plain text."""
+    return len(text) // 4 + 1
+
+class Conversation:
+    """
+    Multi-turn tutoring chat. After an Ollama turn, the 'context' array it returned is sent
+    with the next prompt, so earlier turns are not re-sent and re-tokenized. When no context
+    is available (a Gemini turn, or after summarizing), or when "auto" may route the turn to
+    Gemini, the summary and recent turns are prepended to the prompt as text instead. Once
+    either form grows past 'max_tokens', the conversation so far is summarized before the
+    next turn, with that turn's cancel token and priority, and continues from the summary.
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, max_tokens=CONVERSATION_MAX_TOKENS, keep_turns=CONVERSATION_KEEP_TURNS,
+                 system=None):
+        self.model = model
+        self.system = system  # Fixed instructions sent with every turn
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        self.reset()
+
+    def reset(self):
+        self.context = None
+        self.summary = ""
+        self.turns = []  # (question, answer) pairs since the last summary
+
+    def _transcript(self, turns):
+        return "\n".join(f"Student: {q}\nTutor: {a}" for q, a in turns)
+
+    def _prompt_with_history(self, prompt):
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of the conversation so far:\n{self.summary}")
+        if self.turns:
+            parts.append(f"Recent conversation:\n{self._transcript(self.turns)}")
+        if not parts:
+            return prompt
+        return "\n\n".join(parts) + f"\n\nStudent: {prompt}\nTutor:"
+
+    def stream(self, prompt, **kwargs):
+        """Like stream_ai, continuing this conversation. Extra arguments go to stream_ai."""
+        meta = kwargs.pop("meta", None)
+        meta = {} if meta is None else meta
+        self._enforce_budget(kwargs.get("cancel"), kwargs.get("priority", PRIORITY_INTERACTIVE), kwargs.get("user"))
+        context = self._usable_context()
+        request = prompt if context else self._prompt_with_history(prompt)
+
+        pieces = []
+        for piece in stream_ai(request, model=self.model, context=context, meta=meta, system=self.system, **kwargs):
+            pieces.append(piece)
+            yield piece
+
+        cancel = kwargs.get("cancel")
+        if meta.get("error") or (cancel and cancel.cancelled) or not pieces:
+            return  # Nothing to remember from a failed or abandoned turn
+        self.turns.append((prompt, ''.join(pieces).strip()))
+        self.context = meta.get("context")  # None when Gemini answered: fall back to text history
+
+    def has_history(self):
+        return bool(self.turns or self.summary or self.context)
+
+    def remember(self, prompt, answer):
+        """Records a turn answered without the model (e.g. from a cache); it is carried as text history."""
+        self.turns.append((prompt, answer))
+        self.context = None  # Ollama's context does not contain this turn
+
+    def ask(self, prompt, on_token=None, **kwargs):
+        """Like ask_ai, continuing this conversation."""
+        full_response = []
+        for piece in self.stream(prompt, **kwargs):
+            full_response.append(piece)
+            if on_token:
+                on_token(piece)
+        return ''.join(full_response).strip()
+
+    def _usable_context(self):
+        """Ollama's context, unless the next turn may be answered by a backend that can't use it."""
+        return None if _may_leave_ollama(self.model) else self.context
+
+    def size(self):
+        """Tokens the next turn would carry: Ollama's context length, or the estimated text history."""
+        context = self._usable_context()
+        if context:
+            return len(context)
+        return estimate_tokens(self.summary + self._transcript(self.turns))
+
+    def _enforce_budget(self, cancel=None, priority=PRIORITY_INTERACTIVE, user=None):
+        if self.size() <= self.max_tokens:
+            return
+        keep = self.turns[-self.keep_turns:] if self.keep_turns else []
+        older = self.turns[:len(self.turns) - len(keep)]
+        logging.debug(f"Conversation at {self.size()} tokens; summarizing {len(older)} turns")
+        if older or self.summary:
+            request = (
+                "Summarize this tutoring conversation in a few sentences, keeping the facts, "
+                "the student's level and any open questions.\n\n"
+                + (f"Earlier summary:\n{self.summary}\n\n" if self.summary else "")
+                + self._transcript(older)
+            )
+            meta = {}
+            summary = ask_ai(request, model=self.model, coalesce=False, cancel=cancel, meta=meta,
+                             priority=priority, user=user)
+            if (cancel and cancel.cancelled) or meta.get("error"):
+                return  # Keep the history as it is; the next turn summarizes it
+            self.summary = summary
+        # The text history (summary + kept turns) replaces the oversized context
+        self.turns = keep
+        self.context = None
+        while self.turns and self.size() > self.max_tokens:
+            self.turns.pop(0)
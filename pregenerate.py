@@ -0,0 +1,183 @@
+# pregenerate.py
+"""
+Pre-generates answers for every curriculum topic into a content pack, so the app
+can serve topic explanations with zero LLM latency.
+
+    python pregenerate.py --concurrency 4 --tts
+
+Topics already in the pack are skipped, so an interrupted run can simply be restarted.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ollama_integration
+from content_pack import ContentPack, PACK_FILENAME, prompt_key
+from course_data import build_llm_prompt, build_llm_system_prompt, generation_options, iter_curriculum
+
+def _parse_classes(value):
+    """'1-10' or '3,5,7' -> list of class numbers."""
+    if "-" in value:
+        start, end = value.split("-", 1)
+        return list(range(int(start), int(end) + 1))
+    return [int(v) for v in value.split(",")]
+
+# Seconds a preempted topic waits before it is requested again
+PREEMPTED_RETRY_DELAY = 2.0
+
+def _generate(prompt, system, options, with_audio, voice):
+    started = time.perf_counter()
+    while True:
+        # Background priority only orders requests within this process; the app cannot preempt it
+        try:
+            response = ollama_integration.ask_ai(prompt, model="ollama", raise_errors=True, system=system,
+                                                 options=options, priority=ollama_integration.PRIORITY_BACKGROUND)
+            break
+        except ollama_integration.GenerationPreempted:
+            time.sleep(PREEMPTED_RETRY_DELAY)
+    audio = None
+    if with_audio and response:
+        from tts import synthesize_mp3  # Only needed (and importable) when narration is requested
+        audio = asyncio.run(synthesize_mp3(response, voice))
+    return response, audio, time.perf_counter() - started
+
+async def _generate_async(client, prompt, system, options, with_audio, voice):
+    """_generate on an ollama_async.AsyncLLMClient."""
+    started = time.perf_counter()
+    while True:
+        try:
+            response = await client.ask(prompt, model="ollama", raise_errors=True, system=system, options=options,
+                                        priority=ollama_integration.PRIORITY_BACKGROUND)
+            break
+        except ollama_integration.GenerationPreempted:
+            await asyncio.sleep(PREEMPTED_RETRY_DELAY)
+    audio = None
+    if with_audio and response:
+        from tts import synthesize_mp3
+        audio = await synthesize_mp3(response, voice)
+    return response, audio, time.perf_counter() - started
+
+async def _pregenerate_async(jobs, concurrency, with_audio, voice, on_result):
+    """Runs every job on one event loop, at most 'concurrency' at a time; reports each to 'on_result'."""
+    from ollama_async import AsyncLLMClient  # Needs aiohttp; only loaded with --async
+
+    async with AsyncLLMClient(max_concurrent=concurrency) as client:
+        async def run(job):
+            try:
+                return job, await _generate_async(client, job[4], job[5], generation_options(job[0]),
+                                                  with_audio, voice), None
+            except Exception as e:
+                return job, None, e
+
+        for next_done in asyncio.as_completed([run(job) for job in jobs]):
+            on_result(*(await next_done))
+
+def pregenerate(pack, class_numbers=range(1, 11), concurrency=4, with_audio=False,
+                voice="en-US-AriaNeural", limit=None, use_async=False):
+    """
+    Generates every missing topic of 'class_numbers' into 'pack' with at most
+    'concurrency' requests in flight, on a thread pool or ('use_async') on one event
+    loop with ollama_async. Returns a dict of throughput figures.
+    """
+    done_keys = pack.keys()
+    jobs = []
+    for class_number, subject, unit_number, topic in iter_curriculum(class_numbers):
+        prompt = build_llm_prompt(class_number, subject, unit_number, topic)
+        system = build_llm_system_prompt(class_number, subject)
+        if prompt_key(prompt, system) not in done_keys:
+            jobs.append((class_number, subject, unit_number, topic, prompt, system))
+    if limit is not None:
+        jobs = jobs[:limit]
+    logging.info(f"{len(done_keys)} topics already in pack, {len(jobs)} to generate")
+
+    ollama_integration.configure_http(
+        pool_size={"ollama": concurrency},
+        max_concurrent={"ollama": concurrency},
+    )
+
+    stats = {"generated": 0, "failed": 0, "skipped": len(done_keys), "chars": 0, "elapsed": 0.0}
+    started = time.perf_counter()
+
+    def on_result(job, result, error):
+        class_number, subject, unit_number, topic, prompt, system = job
+        label = f"Class {class_number} {subject} / Unit {unit_number} / {topic}"
+        if error is not None:
+            stats["failed"] += 1
+            logging.error(f"Failed: {label}: {error}")
+            return
+        response, audio, seconds = result
+        if not response:
+            stats["failed"] += 1
+            logging.error(f"Empty response: {label}")
+            return
+        # Committed one topic at a time so an interrupted run loses at most the jobs in flight
+        pack.put(prompt, response, class_number, subject, unit_number, topic,
+                 model=ollama_integration.OLLAMA_MODEL, audio=audio, system=system)
+        stats["generated"] += 1
+        stats["chars"] += len(response)
+        elapsed = time.perf_counter() - started
+        logging.info(
+            f"[{stats['generated'] + stats['failed']}/{len(jobs)}] {label} ({seconds:.1f}s) "
+            f"- {stats['generated'] / elapsed:.2f} topics/s"
+        )
+
+    if use_async:
+        asyncio.run(_pregenerate_async(jobs, concurrency, with_audio, voice, on_result))
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {
+                pool.submit(_generate, job[4], job[5], generation_options(job[0]), with_audio, voice): job
+                for job in jobs
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    on_result(futures[future], None, e)
+                    continue
+                on_result(futures[future], result, None)
+
+    stats["elapsed"] = time.perf_counter() - started
+    stats["topics_per_second"] = stats["generated"] / stats["elapsed"] if stats["elapsed"] else 0.0
+    stats["chars_per_second"] = stats["chars"] / stats["elapsed"] if stats["elapsed"] else 0.0
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-generate curriculum answers into a content pack.")
+    parser.add_argument("--pack", default=PACK_FILENAME, help="Content pack file to create or resume")
+    parser.add_argument("--classes", default="1-10", help="Class numbers, e.g. '1-10' or '6,7'")
+    parser.add_argument("--concurrency", type=int, default=4, help="Generations in flight at once")
+    parser.add_argument("--host", default=ollama_integration.OLLAMA_HOST, help="Ollama host")
+    parser.add_argument("--port", type=int, default=ollama_integration.OLLAMA_PORT, help="Ollama port")
+    parser.add_argument("--model", default=ollama_integration.OLLAMA_MODEL, help="Ollama model name")
+    parser.add_argument("--tts", action="store_true", help="Also store MP3 narration for each answer")
+    parser.add_argument("--voice", default="en-US-AriaNeural", help="edge-tts voice for --tts")
+    parser.add_argument("--limit", type=int, help="Generate at most this many topics")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Run all requests on one event loop (ollama_async) instead of a thread pool")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    ollama_integration.OLLAMA_HOST = args.host
+    ollama_integration.OLLAMA_PORT = args.port
+    ollama_integration.OLLAMA_MODEL = args.model
+
+    pack = ContentPack(args.pack)
+    try:
+        stats = pregenerate(pack, _parse_classes(args.classes), args.concurrency,
+                            with_audio=args.tts, voice=args.voice, limit=args.limit, use_async=args.use_async)
+    finally:
+        pack.close()
+
+    print(
+        f"Generated {stats['generated']} topics ({stats['failed']} failed, {stats['skipped']} already present) "
+        f"in {stats['elapsed']:.1f}s: {stats['topics_per_second']:.2f} topics/s, "
+        f"{stats['chars_per_second']:.0f} chars/s"
+    )
+    return 1 if stats["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from db import DB_FILENAME
+
+# Stored next to the main tutor database
+CACHE_FILENAME = os.path.join(os.path.dirname(DB_FILENAME), "llm_cache.db")
+CACHE_MEMORY_ENTRIES = 256          # Responses kept in the in-memory LRU front
+CACHE_MAX_ENTRIES = 5000            # Responses kept on disk before the least recently used are evicted
+CACHE_TTL_SECONDS = 30 * 24 * 3600  # Responses older than this are regenerated
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_cache (
+    cache_key TEXT PRIMARY KEY,
+    backend TEXT,
+    model TEXT,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used);
+"""
+
+def make_cache_key(backend, model, prompt, options=None):
+    """Content address of a generation: identical inputs always give the same key."""
+    material = json.dumps(
+        {"backend": backend, "model": model, "prompt": prompt, "options": options or {}},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    SQLite-backed LLM response cache with an in-memory LRU in front of it.
+    Entries expire after 'ttl' seconds; the disk table is capped at 'max_entries'.
+    """
+
+    def __init__(self, path=CACHE_FILENAME, memory_entries=CACHE_MEMORY_ENTRIES,
+                 max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (response, created_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.evictions = 0
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _remember(self, key, response, created_at):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached response for 'key', or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return entry[0]
+            self._memory.pop(key, None)
+
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    "SELECT response, created_at FROM llm_cache WHERE cache_key=?", (key,)
+                ).fetchone()
+                if row and now - row[1] >= self.ttl:
+                    conn.execute("DELETE FROM llm_cache WHERE cache_key=?", (key,))
+                    conn.commit()
+                    self.evictions += 1
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE llm_cache SET last_used=? WHERE cache_key=?", (now, key))
+                conn.commit()
+            finally:
+                conn.close()
+
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response, backend=None, model=None):
+        """Stores 'response' under 'key' and evicts expired / least recently used entries."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (cache_key, backend, model, response, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, backend, model, response, now, now),
+                )
+                self._evict(conn, now)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _evict(self, conn, now):
+        expired = conn.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,)).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        overflow = max(0, count - self.max_entries)
+        if overflow:
+            conn.execute(
+                "DELETE FROM llm_cache WHERE cache_key IN "
+                "(SELECT cache_key FROM llm_cache ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+        if expired or overflow:
+            self.evictions += expired + overflow
+            logging.debug(f"LLM cache evicted {expired} expired and {overflow} least recently used entries")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            conn = self._connect()
+            conn.execute("DELETE FROM llm_cache")
+            conn.commit()
+            conn.close()
+
+    def stats(self):
+        """Hit/miss counters plus the current number of entries."""
+        with self._lock:
+            conn = self._connect()
+            entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            conn.close()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "memory_entries": len(self._memory),
+            }
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Returns the process-wide ResponseCache, creating it on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
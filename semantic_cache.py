@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+import requests
+import ollama_integration
+from db import DB_FILENAME
+
+# Stored next to the main tutor database
+SEMANTIC_CACHE_FILENAME = os.path.join(os.path.dirname(DB_FILENAME), "semantic_cache.db")
+SEMANTIC_THRESHOLD = 0.92              # Cosine similarity needed to reuse an answer
+SEMANTIC_MAX_ENTRIES = 2000            # Answers kept before the least recently used are evicted
+SEMANTIC_TTL_SECONDS = 30 * 24 * 3600  # Answers older than this are regenerated
+SEMANTIC_RETRY_SECONDS = 300          # After an embedding failure, the cache is skipped this long
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS semantic_cache (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    embed_model TEXT NOT NULL,
+    model TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    profile TEXT
+);
+"""
+
+def generation_profile(options):
+    """The generation options an answer was made with, as a stable string to match on."""
+    return json.dumps(options or {}, sort_keys=True)
+
+class SemanticCache:
+    """
+    Answers to free-chat questions, looked up by meaning rather than exact text: the
+    question's embedding is compared (cosine similarity) against every stored question
+    in one NumPy matrix product, and the best match above 'threshold' is reused.
+    Only entries made with the current embedding and chat models are loaded, and only
+    answers generated with the same options (see generation_profile) match. After an
+    embedding fails, the cache is skipped for 'retry_seconds'.
+    """
+
+    def __init__(self, path=SEMANTIC_CACHE_FILENAME, threshold=SEMANTIC_THRESHOLD,
+                 max_entries=SEMANTIC_MAX_ENTRIES, ttl=SEMANTIC_TTL_SECONDS, model=None,
+                 retry_seconds=SEMANTIC_RETRY_SECONDS):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.retry_seconds = retry_seconds
+        self._disabled_until = 0.0  # time.monotonic() until which embedding is not attempted
+        self.embed_model = ollama_integration.OLLAMA_EMBED_MODEL
+        self.model = model or ollama_integration._model_name(ollama_integration.DEFAULT_MODEL)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._ids = []
+        self._answers = []
+        self._last_used = []
+        self._profiles = []
+        self._matrix = None  # One unit-length row per entry
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.executescript(SCHEMA)
+            if "profile" not in [column[1] for column in conn.execute("PRAGMA table_info(semantic_cache)")]:
+                # Older entries don't record their options (NULL), so they never match again
+                conn.execute("ALTER TABLE semantic_cache ADD COLUMN profile TEXT")
+            conn.execute("DELETE FROM semantic_cache WHERE created_at <= ?", (time.time() - self.ttl,))
+            conn.commit()
+            rows = conn.execute(
+                "SELECT id, answer, vector, last_used, profile FROM semantic_cache "
+                "WHERE embed_model=? AND model=? AND profile IS NOT NULL ORDER BY last_used DESC LIMIT ?",
+                (self.embed_model, self.model, self.max_entries),
+            ).fetchall()
+        finally:
+            conn.close()
+        vectors = []
+        for row_id, answer, vector, last_used, profile in rows:
+            vector = np.frombuffer(vector, dtype=np.float32)
+            if vectors and vector.shape != vectors[0].shape:
+                continue
+            self._ids.append(row_id)
+            self._answers.append(answer)
+            self._last_used.append(last_used)
+            self._profiles.append(profile)
+            vectors.append(vector)
+        if vectors:
+            self._matrix = np.vstack(vectors)
+
+    def embed(self, text, cancel=None):
+        """
+        The unit-length embedding of 'text', or None if the embedding model is unavailable
+        (then no embedding is attempted for 'retry_seconds') or 'cancel' fired.
+        """
+        if time.monotonic() < self._disabled_until:
+            return None
+        try:
+            vector = np.asarray(ollama_integration.embed(text.strip().lower(), self.embed_model, cancel),
+                                dtype=np.float32)
+        except ollama_integration.GenerationCancelled:
+            return None
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logging.info(f"Embedding failed; semantic cache skipped for {self.retry_seconds}s: {e}")
+            self._disabled_until = time.monotonic() + self.retry_seconds
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def lookup(self, vector, options=None):
+        """
+        Returns (answer, similarity) of the closest stored question answered with the same
+        generation 'options' if it clears the threshold, else None.
+        """
+        profile = generation_profile(options)
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+            similarities = self._matrix @ vector
+            similarities[np.array(self._profiles) != profile] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._last_used[best] = time.time()
+            row_id, answer = self._ids[best], self._answers[best]
+        self._execute("UPDATE semantic_cache SET last_used=? WHERE id=?", (time.time(), row_id))
+        return answer, similarity
+
+    def store(self, question, answer, vector, options=None):
+        """Adds an answer generated with 'options' under the (already computed) embedding of 'question'."""
+        profile = generation_profile(options)
+        now = time.time()
+        with self._lock:
+            if self._matrix is not None and self._matrix.shape[1] != vector.shape[0]:
+                return
+            conn = sqlite3.connect(self.path, timeout=10)
+            try:
+                row_id = conn.execute(
+                    "INSERT INTO semantic_cache (embed_model, model, question, answer, vector, created_at, last_used, "
+                    "profile) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.embed_model, self.model, question, answer,
+                     vector.astype(np.float32).tobytes(), now, now, profile),
+                ).lastrowid
+                self._ids.append(row_id)
+                self._answers.append(answer)
+                self._last_used.append(now)
+                self._profiles.append(profile)
+                row = vector.astype(np.float32)[np.newaxis, :]
+                self._matrix = row if self._matrix is None else np.vstack([self._matrix, row])
+                self._evict(conn)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _evict(self, conn):
+        overflow = len(self._ids) - self.max_entries
+        if overflow <= 0:
+            return
+        oldest = np.argsort(self._last_used)[:overflow]
+        conn.executemany("DELETE FROM semantic_cache WHERE id=?", [(self._ids[i],) for i in oldest])
+        keep = np.setdiff1d(np.arange(len(self._ids)), oldest)
+        self._ids = [self._ids[i] for i in keep]
+        self._answers = [self._answers[i] for i in keep]
+        self._last_used = [self._last_used[i] for i in keep]
+        self._profiles = [self._profiles[i] for i in keep]
+        self._matrix = self._matrix[keep]
+        self.evictions += overflow
+
+    def _execute(self, sql, args):
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute(sql, args)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._ids),
+            }
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_semantic_cache():
+    """Returns the process-wide SemanticCache, creating (and loading) it on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SemanticCache()
+        return _default_cache
@@ -0,0 +1,236 @@
+# stub_ollama.py
+"""
+A deterministic stand-in for an Ollama server, for testing and benchmarking the LLM
+path without a model. Speaks /api/generate (streaming and not), /api/tags and
+/api/embeddings, with configurable timing and failure injection.
+
+    python stub_ollama.py --port 11500 --tokens-per-second 40 --first-token-delay 0.3
+
+Point the app or loadtest.py at it with OLLAMA_HOST/OLLAMA_PORT (or --host/--port).
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Defaults for the simulated model
+STUB_MODEL = "stub-model"
+STUB_TOKENS_PER_SECOND = 30.0   # Generation speed after the first token
+STUB_FIRST_TOKEN_DELAY = 0.2    # Seconds of simulated prefill before the first token
+STUB_RESPONSE_TOKENS = 60       # Tokens in every answer
+STUB_FAILURE_RATE = 0.0         # Fraction of generations that fail (see STUB_FAILURE_MODE)
+STUB_FAILURE_MODE = "http"      # "http": answer 503; "drop": close the stream half way
+STUB_EMBEDDING_SIZE = 64
+
+WORDS = ("light", "energy", "force", "motion", "the", "a", "is", "of", "and", "moves",
+         "gravity", "pendulum", "circuit", "wave", "heat", "because", "when", "plants", "cells", "water")
+
+def _seed(text):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+def stub_answer(prompt, tokens=STUB_RESPONSE_TOKENS):
+    """The answer the stub gives to 'prompt': the same words every time for the same prompt."""
+    rng = random.Random(_seed(prompt))
+    return [(" " if i else "") + rng.choice(WORDS) for i in range(tokens)]
+
+def stub_embedding(text, size=STUB_EMBEDDING_SIZE):
+    """A unit vector built from the words of 'text', so texts sharing words come out similar."""
+    vector = [0.0] * size
+    for word in text.lower().split():
+        rng = random.Random(_seed(word.strip(".,!?")))
+        for i in range(size):
+            vector[i] += rng.uniform(-1.0, 1.0)
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real server
+    disable_nagle_algorithm = True  # Headers and body are written separately; don't let them wait on ACKs
+
+    def log_message(self, format, *args):
+        logging.debug("stub: " + format % args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _write_chunk(self, data):
+        line = json.dumps(data).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": self.server.model, "model": self.server.model}]})
+        elif self.path == "/":
+            self._send_json({"status": "Ollama is running"})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path == "/api/generate":
+            self._generate(request)
+        elif self.path in ("/api/embeddings", "/api/embed"):
+            text = request.get("prompt", request.get("input", ""))
+            if self.path == "/api/embed":
+                texts = text if isinstance(text, list) else [text]
+                self._send_json({"embeddings": [stub_embedding(t, self.server.embedding_size) for t in texts]})
+            else:
+                self._send_json({"embedding": stub_embedding(text, self.server.embedding_size)})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _generate(self, request):
+        server = self.server
+        server.count_request()
+        if not request.get("prompt"):
+            self._send_json({"model": server.model, "response": "", "done": True, "done_reason": "load"})
+            return
+        fail = server.rng_uniform() < server.failure_rate
+        if fail and server.failure_mode == "http":
+            self._send_json({"error": "injected failure"}, status=503)
+            return
+
+        prompt = (request.get("system") or "") + request["prompt"]
+        tokens = stub_answer(prompt, server.response_tokens)
+        limit = request.get("options", {}).get("num_predict")
+        if limit is not None and limit >= 0:
+            tokens = tokens[:limit]
+        started = time.perf_counter()
+        time.sleep(server.first_token_delay)
+        prefill = time.perf_counter() - started
+
+        if not request.get("stream", True):
+            time.sleep(len(tokens) / server.tokens_per_second)
+            self._send_json(self._final_chunk(request, tokens, prefill, started, "".join(tokens)))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(1.0 / server.tokens_per_second)
+                if fail and i == len(tokens) // 2:
+                    self.close_connection = True
+                    return
+                self._write_chunk({"model": server.model, "response": token, "done": False})
+            self._write_chunk(self._final_chunk(request, tokens, prefill, started, ""))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # The client cancelled
+
+    def _final_chunk(self, request, tokens, prefill, started, response):
+        total = time.perf_counter() - started
+        prompt_tokens, evaluated = self.server.prefill(request)
+        return {
+            "model": self.server.model,
+            "response": response,
+            "done": True,
+            "done_reason": "stop",
+            "context": list(range(prompt_tokens + len(tokens))),
+            "total_duration": int(total * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": evaluated,
+            "prompt_eval_duration": int(prefill * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int((total - prefill) * 1e9),
+        }
+
+class StubOllamaServer(ThreadingHTTPServer):
+    """The stub server; serve_forever() it on a thread, or use start_stub_server()."""
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), model=STUB_MODEL, tokens_per_second=STUB_TOKENS_PER_SECOND,
+                 first_token_delay=STUB_FIRST_TOKEN_DELAY, response_tokens=STUB_RESPONSE_TOKENS,
+                 failure_rate=STUB_FAILURE_RATE, failure_mode=STUB_FAILURE_MODE,
+                 embedding_size=STUB_EMBEDDING_SIZE, seed=0):
+        super().__init__(address, StubOllamaHandler)
+        self.model = model
+        self.tokens_per_second = tokens_per_second
+        self.first_token_delay = first_token_delay
+        self.response_tokens = response_tokens
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.embedding_size = embedding_size
+        self.generate_requests = 0
+        self._systems = set()  # System prompts whose prefill is "cached"
+        self._rng = random.Random(seed)  # Failure injection is reproducible for a given seed
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count_request(self):
+        with self._lock:
+            self.generate_requests += 1
+
+    def prefill(self, request):
+        """
+        (prompt tokens, tokens evaluated) for 'request', one token per word: the carried context
+        and a system prompt seen before count as reused from the prefix cache, like Ollama.
+        """
+        system = request.get("system") or ""
+        context = len(request.get("context") or ())
+        prompt_tokens = context + len(system.split()) + len(request.get("prompt", "").split())
+        with self._lock:
+            cached = context + (len(system.split()) if system in self._systems else 0)
+            self._systems.add(system)
+        return prompt_tokens, max(prompt_tokens - cached, 1)
+
+    def rng_uniform(self):
+        with self._lock:
+            return self._rng.random()
+
+def start_stub_server(host="127.0.0.1", port=0, **settings):
+    """Starts a StubOllamaServer on a daemon thread and returns it (port 0 picks a free port)."""
+    server = StubOllamaServer((host, port), **settings)
+    threading.Thread(target=server.serve_forever, name="StubOllama", daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a deterministic stand-in for an Ollama server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=11500, help="Port to listen on")
+    parser.add_argument("--model", default=STUB_MODEL, help="Model name reported by /api/tags")
+    parser.add_argument("--tokens-per-second", type=float, default=STUB_TOKENS_PER_SECOND)
+    parser.add_argument("--first-token-delay", type=float, default=STUB_FIRST_TOKEN_DELAY, help="Seconds")
+    parser.add_argument("--response-tokens", type=int, default=STUB_RESPONSE_TOKENS)
+    parser.add_argument("--failure-rate", type=float, default=STUB_FAILURE_RATE, help="0.0 - 1.0")
+    parser.add_argument("--failure-mode", choices=("http", "drop"), default=STUB_FAILURE_MODE)
+    parser.add_argument("--seed", type=int, default=0, help="Seed for failure injection")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
+    server = StubOllamaServer((args.host, args.port), model=args.model, tokens_per_second=args.tokens_per_second,
+                              first_token_delay=args.first_token_delay, response_tokens=args.response_tokens,
+                              failure_rate=args.failure_rate, failure_mode=args.failure_mode, seed=args.seed)
+    logging.info(f"Stub Ollama listening on http://{args.host}:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
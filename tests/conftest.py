@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_metrics
+import ollama_integration
+import response_cache
+from stub_ollama import start_stub_server
+
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    """A stub_ollama server as the only Ollama host, with caches and metrics kept in tmp_path."""
+    server = start_stub_server(tokens_per_second=200, first_token_delay=0.05, response_tokens=40)
+    monkeypatch.setattr(ollama_integration, "OLLAMA_HOST", "127.0.0.1")
+    monkeypatch.setattr(ollama_integration, "OLLAMA_PORT", server.port)
+    monkeypatch.setattr(ollama_integration, "OLLAMA_HOSTS", [])
+    monkeypatch.setattr(ollama_integration, "_breakers", {})
+    monkeypatch.setattr(response_cache, "_default_cache", response_cache.ResponseCache(path=str(tmp_path / "cache.db")))
+    monkeypatch.setattr(llm_metrics, "_default_recorder", llm_metrics.MetricsRecorder(path=None))
+    retries = ollama_integration.HTTP_RETRIES
+    ollama_integration.configure_http(retries=0)  # Injected failures should fail, not be retried
+    yield server
+    ollama_integration.configure_http(retries=retries)
+    server.shutdown()
+    server.server_close()
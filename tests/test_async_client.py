@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from ollama_integration import INTERRUPTED_NOTICE, GenerationPreempted, PRIORITY_BACKGROUND, ask_ai
+
+aiohttp = pytest.importorskip("aiohttp")
+from ollama_async import AsyncLLMClient
+
+
+def _ask_async(prompt, **kwargs):
+    async def run():
+        client = AsyncLLMClient()
+        try:
+            return await client.ask(prompt, **kwargs)
+        finally:
+            await client.close()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("failure_mode", [None, "http", "drop"])
+def test_async_and_blocking_paths_give_the_same_result(stub, failure_mode):
+    if failure_mode:
+        stub.failure_rate = 1.0
+        stub.failure_mode = failure_mode
+    sync_meta, async_meta = {}, {}
+
+    blocking = ask_ai("Explain friction", system="You are a tutor.", meta=sync_meta)
+    asynchronous = _ask_async("Explain friction", system="You are a tutor.", meta=async_meta)
+
+    assert asynchronous == blocking
+    assert ("error" in async_meta) == ("error" in sync_meta) == bool(failure_mode)
+    assert async_meta["cache"] == sync_meta["cache"]
+
+
+def test_a_broken_off_answer_ends_with_a_separate_notice(stub):
+    stub.failure_rate = 1.0
+    stub.failure_mode = "drop"
+
+    for answer in (ask_ai("Explain friction"), _ask_async("Explain friction")):
+        text, notice, rest = answer.partition(INTERRUPTED_NOTICE)
+        assert text and notice and not rest
+        assert "Error" not in answer
+
+
+def test_async_context_continues_a_conversation(stub):
+    first = {}
+    _ask_async("What is light?", meta=first)
+    assert first["context"]
+    follow_up = {}
+    _ask_async("Tell me more", context=first["context"], meta=follow_up)
+    assert len(follow_up["context"]) > len(first["context"])
+
+
+def test_async_background_request_is_preempted(stub, monkeypatch):
+    import ollama_integration
+    monkeypatch.setitem(ollama_integration.BACKEND_MAX_CONCURRENT, "ollama", 1)
+    monkeypatch.setattr(ollama_integration, "_backend_slots", {})
+    stub.first_token_delay = 0.3
+
+    async def run():
+        client = AsyncLLMClient()
+        try:
+            background = asyncio.ensure_future(client.ask("Warm the cache", priority=PRIORITY_BACKGROUND,
+                                                           raise_errors=True))
+            await asyncio.sleep(0.1)
+            interactive = await client.ask("A student's question")
+            with pytest.raises(GenerationPreempted):
+                await background
+            return interactive
+        finally:
+            await client.close()
+
+    assert asyncio.run(run())
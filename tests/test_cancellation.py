@@ -0,0 +1,30 @@
+import threading
+import time
+
+import pytest
+
+import ollama_integration
+from ollama_integration import CancelToken, ask_ai
+
+
+@pytest.mark.parametrize("coalesce", [False, True])
+def test_cancel_before_the_first_token_returns_promptly(stub, coalesce):
+    stub.first_token_delay = 3.0  # Model load / prefill: no response headers yet
+    cancel = CancelToken()
+    threading.Timer(0.2, cancel.cancel).start()
+    started = time.perf_counter()
+    meta = {}
+
+    answer = ask_ai("Explain gravity", coalesce=coalesce, cancel=cancel, meta=meta)
+
+    assert time.perf_counter() - started < 1.0
+    assert answer == ""
+    assert "error" not in meta
+    assert ollama_integration.get_breaker("ollama").stats()["failures"] == 0
+
+
+def test_cancelled_embedding_raises_generation_cancelled(stub):
+    cancel = CancelToken()
+    cancel.cancel()
+    with pytest.raises(ollama_integration.GenerationCancelled):
+        ollama_integration.embed("light", cancel=cancel)
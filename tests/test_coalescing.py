@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+import pytest
+
+import ollama_integration
+from ollama_integration import CancelToken, stream_ai
+from response_cache import get_response_cache, make_cache_key
+from stub_ollama import stub_answer
+
+
+def _cache_key(prompt):
+    return make_cache_key("ollama", ollama_integration._model_name("ollama"), prompt, {})
+
+
+def _cancel_after(prompt, pieces):
+    """Streams 'prompt' with coalescing and the cache, cancelling after 'pieces' pieces."""
+    cancel = CancelToken()
+    received = []
+    for piece in stream_ai(prompt, use_cache=True, cancel=cancel):
+        received.append(piece)
+        if len(received) == pieces:
+            cancel.cancel()
+    return received
+
+
+@pytest.mark.parametrize("pieces", [5, 0])
+def test_request_after_abandoned_flight_gets_a_full_answer(stub, pieces):
+    prompt = "Explain the pendulum"
+    expected = "".join(stub_answer(prompt, stub.response_tokens)).strip()
+    if pieces:
+        assert len(_cancel_after(prompt, pieces)) == pieces
+    else:
+        cancel = CancelToken()
+        threading.Timer(0.01, cancel.cancel).start()  # Still waiting for the first token
+        assert list(stream_ai(prompt, use_cache=True, cancel=cancel)) == []
+
+    meta = {}
+    answer = "".join(stream_ai(prompt, use_cache=True, meta=meta)).strip()
+
+    assert "error" not in meta
+    assert answer == expected
+    assert get_response_cache().get(_cache_key(prompt)) == expected
+    assert not ollama_integration._flights
+
+
+def test_last_subscriber_leaving_forgets_the_flight(stub):
+    key = ("abandoned", ollama_integration.PRIORITY_INTERACTIVE)
+    cancel = CancelToken()
+    stream = ollama_integration._stream_coalesced(key, "ollama", "Explain heat", cancel=cancel)
+    next(stream)
+    assert key in ollama_integration._flights
+    cancel.cancel()
+    with pytest.raises(ollama_integration.GenerationCancelled):
+        list(stream)
+    assert key not in ollama_integration._flights
+
+
+def test_async_request_after_abandoned_flight_gets_a_full_answer(stub):
+    pytest.importorskip("aiohttp")
+    from ollama_async import AsyncLLMClient
+
+    prompt = "Explain the circuit"
+    expected = "".join(stub_answer(prompt, stub.response_tokens)).strip()
+
+    async def run():
+        client = AsyncLLMClient()
+        try:
+            received = []
+
+            async def consume():
+                async for piece in client.stream(prompt, use_cache=True):
+                    received.append(piece)
+                    if len(received) == 5:
+                        task.cancel()
+
+            task = asyncio.ensure_future(consume())
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert not client._flights
+            meta = {}
+            answer = await client.ask(prompt, use_cache=True, meta=meta)
+            return received, answer, meta
+        finally:
+            await client.close()
+
+    received, answer, meta = asyncio.run(run())
+    assert len(received) == 5
+    assert "error" not in meta
+    assert answer == expected
+    assert get_response_cache().get(_cache_key(prompt)) == expected
@@ -0,0 +1,17 @@
+from ollama_integration import Conversation
+
+
+def test_failed_summary_keeps_the_history(stub):
+    conversation = Conversation(model="ollama", max_tokens=100, keep_turns=1)
+    for question in ("What is light?", "What is heat?", "What is a wave?"):
+        conversation.turns.append((question, "An answer long enough to push the conversation over its budget " * 2))
+
+    stub.failure_rate = 1.0
+    conversation.ask("And sound?")
+    assert len(conversation.turns) == 3
+    assert conversation.summary == ""
+
+    stub.failure_rate = 0.0
+    conversation.ask("And sound?")
+    assert conversation.summary
+    assert len(conversation.turns) == 2  # The kept turn plus the new one
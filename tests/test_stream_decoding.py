@@ -0,0 +1,8 @@
+from ollama_integration import NDJSONDecoder, _stdlib_json_loads
+
+
+def test_lines_with_trailing_bytes_are_rejected():
+    decoder = NDJSONDecoder()
+    objects = decoder.feed(b'{"response":"a"}\n{"response":"x"}garbage\n{"response":"b"} \n')
+    assert [obj["response"] for obj in objects] == ["a", "b"]
+    assert _stdlib_json_loads(b' {"done":true}') == {"done": True}
@@ -0,0 +1,30 @@
+import time
+
+import pytest
+
+import ollama_integration
+from ollama_integration import PRIORITY_COURSE, ask_ai
+
+pytest.importorskip("PyQt5")
+import workers
+from workers import TopicWarmer
+
+
+def test_topic_warmer_gives_way_to_students_and_fills_the_cache(stub, monkeypatch):
+    monkeypatch.setitem(ollama_integration.BACKEND_MAX_CONCURRENT, "ollama", 1)
+    monkeypatch.setattr(ollama_integration, "_backend_slots", {})
+    monkeypatch.setattr(workers, "WARM_RETRY_DELAY", 0.05)
+    stub.first_token_delay = 0.2
+    jobs = [(f"Explain topic {n}", "You are a tutor.") for n in range(3)]
+    warmer = TopicWarmer(jobs)
+    warmer.start()
+    time.sleep(0.1)  # The warmer holds the only slot
+
+    assert ask_ai("A student's question", priority=PRIORITY_COURSE)
+    warmer.join(10)
+
+    assert ollama_integration.scheduler_stats()["ollama"]["preemptions"] >= 1
+    for prompt, system in jobs:
+        meta = {}
+        ask_ai(prompt, model=warmer.model, use_cache=True, system=system, meta=meta)
+        assert meta["cache"] == "hit"
@@ -1,80 +1,327 @@
-import os
 import asyncio
-from PyQt5.QtCore import QThread, pyqtSignal
+import io
+import itertools
+import logging
+import re
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
 import edge_tts
 import simpleaudio as sa
-from pydub import AudioSegment
+from tts_cache import PCMAudio, get_tts_cache
 
-class TTSThread(QThread):
-    speaking = pyqtSignal()
-    finished = pyqtSignal()
+try:
+    import miniaudio  # Optional: decodes MP3 in-process; otherwise pydub runs ffmpeg per sentence
+except ImportError:
+    miniaudio = None
 
-    def __init__(self, text, voice="en-US-AriaNeural"):
-        super().__init__()
-        self.text = text
+# Sentence pipelining
+SENTENCE_BREAK = re.compile(r"(?<=[.!?:;])[\"')\]]*\s+|\n+")  # Where a spoken segment may end
+SENTENCE_MIN_CHARS = 24       # Shorter segments ("1.", "e.g.") are joined with the next one
+TTS_PREFETCH_SENTENCES = 1    # Synthesized sentences queued behind the one playing, per utterance
+TTS_PREFETCH_JOBS = 2         # Queued utterances synthesized ahead while an earlier one plays
+PLAYBACK_POLL_SECONDS = 0.02  # How often playback checks whether it is done (and can be interrupted)
+
+async def synthesize_mp3(text, voice="en-US-AriaNeural"):
+    """Returns the synthesized speech for 'text' as MP3 bytes."""
+    audio = bytearray()
+    async for chunk in edge_tts.Communicate(text, voice).stream():
+        if chunk["type"] == "audio":
+            audio.extend(chunk["data"])
+    return bytes(audio)
+
+def decode_mp3(mp3):
+    """Decodes MP3 bytes to 16-bit PCMAudio in memory, without temporary files."""
+    if miniaudio is not None:
+        decoded = miniaudio.decode(mp3, output_format=miniaudio.SampleFormat.SIGNED16)
+        return PCMAudio(decoded.samples.tobytes(), decoded.nchannels, 2, decoded.sample_rate)
+    from pydub import AudioSegment
+    segment = AudioSegment.from_file(io.BytesIO(mp3), format="mp3")
+    return PCMAudio(segment.raw_data, segment.channels, segment.sample_width, segment.frame_rate)
+
+class SentenceSplitter:
+    """Cuts streamed text into sentences, returning each one as soon as it is complete."""
+
+    def __init__(self, min_chars=SENTENCE_MIN_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, text):
+        """Adds 'text' and returns the sentences it completed."""
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_BREAK.finditer(self._buffer):
+            if match.start() - start < self.min_chars:
+                continue
+            sentence = self._buffer[start:match.start()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self):
+        """Returns whatever is left as the last sentence."""
+        rest, self._buffer = self._buffer.strip(), ""
+        return [rest] if rest else []
+
+class SpeechJob:
+    """
+    One utterance queued on a SpeechService. Text given to submit() is spoken as is;
+    otherwise it arrives through feed() (e.g. while the LLM is still generating) until end().
+    feed(), end() and cancel() are called from the GUI thread. Each job has its own
+    sentence and audio buffers, so several can be synthesized at once.
+    """
+
+    def __init__(self, service, job_id, voice, audio=None, prefetch=TTS_PREFETCH_SENTENCES):
+        self.id = job_id
         self.voice = voice
-        self.output_mp3 = "speech.mp3"
-        self.output_wav = "speech.wav"
+        self.audio = audio  # Pre-synthesized MP3 bytes (e.g. from a content pack)
+        self.cancelled = False
+        self.started = False
+        self.producer = None  # The loop-side task synthesizing this job
+        self.task = None  # The loop-side task playing this job
+        self._service = service
+        self._splitter = SentenceSplitter()
+        self._sentences = asyncio.Queue()  # Used on the loop thread only; None ends the utterance
+        self._ready = asyncio.Queue(maxsize=prefetch)  # Decoded sentences waiting to play; None ends
+        self._ended = False
 
-    async def generate_audio(self):
-        """Generate TTS audio file in MP3 format."""
-        try:
-            tts = edge_tts.Communicate(self.text, self.voice)
-            await tts.save(self.output_mp3)
-        except Exception as e:
-            print(f"Error generating TTS audio: {e}")
+    def feed(self, text):
+        """Adds streamed text; complete sentences are queued for synthesis at once."""
+        if self._ended:
+            return
+        for sentence in self._splitter.feed(text):
+            self._service._call(self._sentences.put_nowait, sentence)
+
+    def end(self):
+        """Marks the text as complete, queueing its last sentence."""
+        if self._ended:
+            return
+        self._ended = True
+        for sentence in self._splitter.flush():
+            self._service._call(self._sentences.put_nowait, sentence)
+        self._service._call(self._sentences.put_nowait, None)
+
+    def cancel(self):
+        self._service.cancel(self)
+
+class SpeechService(QObject):
+    """
+    Speaks SpeechJobs one after another on a single long-lived asyncio loop thread.
+    Within a job, the next sentence is synthesized while the current one plays, so
+    speech starts after the first sentence; up to 'prefetch_jobs' queued jobs are
+    synthesized ahead as well, so the next utterance is ready when this one ends.
+    Cancelling a job stops its playback at the next poll and drops its remaining
+    sentences; no thread is ever killed.
+    """
+    speaking = pyqtSignal(int)  # job id; its first audio started
+    finished = pyqtSignal(int)  # job id; spoken to the end, cancelled or failed
+
+    def __init__(self, cache=None, prefetch=TTS_PREFETCH_SENTENCES, prefetch_jobs=TTS_PREFETCH_JOBS):
+        super().__init__()
+        self.cache = cache
+        self.prefetch = prefetch
+        self.prefetch_jobs = prefetch_jobs
+        self._ids = itertools.count(1)
+        self._jobs = {}  # id -> SpeechJob, queued or speaking
+        self._jobs_lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._queue = asyncio.Queue()  # Submitted jobs, in order; used on the loop thread only
+        self._playlist = asyncio.Queue()  # Jobs being synthesized, in order; played one at a time
+        self._slots = asyncio.Semaphore(1 + prefetch_jobs)  # Bounds the jobs being synthesized
+        self._thread = threading.Thread(target=self._loop.run_forever, name="SpeechService", daemon=True)
+        self._thread.start()
+        self._worker = asyncio.run_coroutine_threadsafe(self._work(), self._loop)
+
+    def _call(self, callback, *args):
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def submit(self, text=None, voice="en-US-AriaNeural", audio=None, replace=True):
+        """
+        Queues an utterance and returns its SpeechJob. With 'replace', everything queued or
+        speaking is cancelled first; otherwise the job waits for the ones before it.
+        """
+        if replace:
+            self.cancel_all()
+        job = SpeechJob(self, next(self._ids), voice, audio=audio, prefetch=self.prefetch)
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+        if audio is not None:
+            job.end()
+        elif text is not None:
+            job.feed(text)
+            job.end()
+        self._call(self._queue.put_nowait, job)
+        return job
+
+    def cancel(self, job):
+        job.cancelled = True
+        self._call(self._cancel_task, job)
 
-    def convert_mp3_to_wav(self):
-        """Convert MP3 to WAV format for playback."""
+    def cancel_all(self):
+        with self._jobs_lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            self.cancel(job)
+
+    def _cancel_task(self, job):
+        for task in (job.producer, job.task):
+            if task is not None:
+                task.cancel()
+
+    async def _work(self):
+        player = self._loop.create_task(self._play_jobs())
         try:
-            audio = AudioSegment.from_file(self.output_mp3, format="mp3")
-            audio.export(self.output_wav, format="wav")
-        except Exception as e:
-            print(f"Error converting MP3 to WAV: {e}")
+            while True:
+                job = await self._queue.get()
+                await self._slots.acquire()
+                if job.cancelled:
+                    self._slots.release()
+                    self._done(job)
+                    continue
+                job.producer = self._loop.create_task(self._synthesize_sentences(job))
+                self._playlist.put_nowait(job)
+        finally:
+            player.cancel()
+
+    async def _play_jobs(self):
+        while True:
+            job = await self._playlist.get()
+            try:
+                if not job.cancelled:
+                    job.task = self._loop.create_task(self._speak(job))
+                    await asyncio.wait([job.task])
+                    if not job.task.cancelled() and job.task.exception() is not None:
+                        logging.error(f"Error speaking: {job.task.exception()}")
+            finally:
+                job.producer.cancel()
+                self._slots.release()
+                self._done(job)
+
+    def _done(self, job):
+        with self._jobs_lock:
+            self._jobs.pop(job.id, None)
+        self.finished.emit(job.id)
 
-    def play_audio(self):
-        """Play the WAV file using simpleaudio."""
+    async def _speak(self, job):
+        while True:
+            pcm = await job._ready.get()
+            if pcm is None:
+                break
+            await self._play(job, pcm)
+
+    async def _synthesize_sentences(self, job):
+        if job.audio is not None:
+            try:
+                await job._ready.put(await self._loop.run_in_executor(None, decode_mp3, job.audio))
+            except Exception as e:
+                logging.error(f"Error decoding speech: {e}")
+            await job._ready.put(None)
+            return
+        while True:
+            sentence = await job._sentences.get()
+            if sentence is None:
+                break
+            try:
+                pcm = await self._synthesize(job.voice, sentence)
+            except Exception as e:
+                logging.error(f"Error synthesizing speech for {sentence!r}: {e}")
+                continue
+            await job._ready.put(pcm)
+        await job._ready.put(None)
+
+    async def _synthesize(self, voice, sentence):
+        if self.cache is not None:
+            pcm = await self._loop.run_in_executor(None, self.cache.get, voice, sentence)
+            if pcm is not None:
+                return pcm
+        mp3 = await synthesize_mp3(sentence, voice)
+        pcm = await self._loop.run_in_executor(None, decode_mp3, mp3)
+        if self.cache is not None:
+            await self._loop.run_in_executor(None, self.cache.put, voice, sentence, pcm)
+        return pcm
+
+    async def _play(self, job, pcm):
+        """Plays 'pcm', polling so that cancelling the job stops it promptly."""
+        if not job.started:
+            job.started = True
+            self.speaking.emit(job.id)
+        play_obj = sa.play_buffer(pcm.data, pcm.channels, pcm.sample_width, pcm.sample_rate)
         try:
-            wave_obj = sa.WaveObject.from_wave_file(self.output_wav)
-            play_obj = wave_obj.play()
-            play_obj.wait_done()  # Block until playback is finished
-        except Exception as e:
-            print(f"Error playing TTS audio: {e}")
+            while play_obj.is_playing():
+                await asyncio.sleep(PLAYBACK_POLL_SECONDS)
         finally:
-            # Cleanup files
-            if os.path.exists(self.output_mp3):
-                os.remove(self.output_mp3)
-            if os.path.exists(self.output_wav):
-                os.remove(self.output_wav)
-
-    def run(self):
-        """Main TTS processing function."""
-        self.speaking.emit()
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.generate_audio())  # Generate MP3
-        self.convert_mp3_to_wav()  # Convert MP3 to WAV
-        self.play_audio()  # Play the WAV file
-        self.finished.emit()
+            play_obj.stop()
+
+    def shutdown(self):
+        """Cancels all speech and stops the loop thread."""
+        self.cancel_all()
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result(timeout=5)
+        self._call(self._loop.stop)
+        self._thread.join(timeout=5)
+
+    async def _close(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 class OfflineTTS:
-    def __init__(self, default_voice="en-US-AriaNeural"):
-        self.tts_thread = None
+    def __init__(self, default_voice="en-US-AriaNeural", cache=True):
         self.voice = default_voice
+        self.cache = get_tts_cache() if cache else None  # Repeated sentences skip synthesis
+        self.service = SpeechService(cache=self.cache)
+        self.current = None  # The SpeechJob started last
+        self._callbacks = {}  # job id -> (on_speaking, on_finished)
+        self.service.speaking.connect(self._on_speaking)
+        self.service.finished.connect(self._on_finished)
 
     def set_voice(self, voice):
         """Change the voice dynamically."""
         self.voice = voice
 
-    def speak(self, text, on_speaking=None, on_finished=None):
-        """Generate and play speech asynchronously."""
-        if self.tts_thread and self.tts_thread.isRunning():
-            self.tts_thread.terminate()
+    def speak(self, text, on_speaking=None, on_finished=None, audio=None, replace=True):
+        """
+        Speaks 'text', replacing whatever is being spoken (or, with replace=False, after it;
+        its audio is synthesized meanwhile). 'audio' skips synthesis with ready MP3 bytes.
+        """
+        job = self.service.submit(text, voice=self.voice, audio=audio, replace=replace)
+        self._start(job, on_speaking, on_finished)
+
+    def start_stream(self, on_speaking=None, on_finished=None):
+        """Starts an utterance whose text arrives through feed(); speech begins with its first sentence."""
+        self._start(self.service.submit(voice=self.voice), on_speaking, on_finished)
+
+    def feed(self, text):
+        if self.current:
+            self.current.feed(text)
+
+    def end_stream(self):
+        if self.current:
+            self.current.end()
 
-        self.tts_thread = TTSThread(text, voice=self.voice)
+    def stop(self):
+        """Stops whatever is being spoken."""
+        self.current = None
+        self.service.cancel_all()
+
+    def shutdown(self):
+        self.stop()
+        self.service.shutdown()
+
+    def _start(self, job, on_speaking, on_finished):
+        self.current = job
+        if on_speaking or on_finished:
+            self._callbacks[job.id] = (on_speaking, on_finished)
+
+    def _on_speaking(self, job_id):
+        on_speaking = self._callbacks.get(job_id, (None, None))[0]
         if on_speaking:
-            self.tts_thread.speaking.connect(on_speaking)
+            on_speaking()
+
+    def _on_finished(self, job_id):
+        on_finished = self._callbacks.pop(job_id, (None, None))[1]
         if on_finished:
-            self.tts_thread.finished.connect(on_finished)
-        self.tts_thread.start()
+            on_finished()
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from db import DB_FILENAME
+
+# Stored next to the main tutor database
+TTS_CACHE_FILENAME = os.path.join(os.path.dirname(DB_FILENAME), "tts_cache.db")
+TTS_CACHE_MEMORY_BYTES = 32 * 1024 * 1024  # Decoded audio kept in the in-memory LRU front
+TTS_CACHE_MAX_BYTES = 256 * 1024 * 1024    # Audio kept on disk before the least recently used is evicted
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tts_cache (
+    cache_key TEXT PRIMARY KEY,
+    voice TEXT NOT NULL,
+    text TEXT NOT NULL,
+    pcm BLOB NOT NULL,
+    channels INTEGER NOT NULL,
+    sample_width INTEGER NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tts_cache_last_used ON tts_cache (last_used);
+"""
+
+# Raw audio ready for simpleaudio.play_buffer
+PCMAudio = namedtuple("PCMAudio", "data channels sample_width sample_rate")
+
+def normalize_text(text):
+    """Collapses whitespace so the same words always map to the same entry."""
+    return " ".join(text.split())
+
+def make_tts_key(voice, text):
+    """Content address of an utterance: the voice plus its normalized text."""
+    return hashlib.sha256(f"{voice}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class TTSCache:
+    """
+    Decoded speech (PCMAudio) by (voice, normalized text): an in-memory LRU capped at
+    'memory_bytes' in front of a SQLite table capped at 'max_bytes', evicting the least
+    recently used audio first. A hit skips both synthesis and decoding.
+    """
+
+    def __init__(self, path=TTS_CACHE_FILENAME, memory_bytes=TTS_CACHE_MEMORY_BYTES,
+                 max_bytes=TTS_CACHE_MAX_BYTES):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()  # key -> PCMAudio
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.evictions = 0
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _remember(self, key, pcm):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous.data)
+        self._memory[key] = pcm
+        self._memory_size += len(pcm.data)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_size -= len(dropped.data)
+
+    def get(self, voice, text):
+        """Returns the cached PCMAudio for 'text' in 'voice', or None on a miss."""
+        key = make_tts_key(voice, text)
+        with self._lock:
+            pcm = self._memory.get(key)
+            if pcm is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return pcm
+
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    "SELECT pcm, channels, sample_width, sample_rate FROM tts_cache WHERE cache_key=?", (key,)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE tts_cache SET last_used=? WHERE cache_key=?", (time.time(), key))
+                conn.commit()
+            finally:
+                conn.close()
+
+            pcm = PCMAudio(bytes(row[0]), row[1], row[2], row[3])
+            self._remember(key, pcm)
+            self.hits += 1
+            return pcm
+
+    def put(self, voice, text, pcm):
+        """Stores 'pcm' as the speech for 'text' in 'voice' and evicts down to the size cap."""
+        key = make_tts_key(voice, text)
+        now = time.time()
+        with self._lock:
+            self._remember(key, pcm)
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tts_cache (cache_key, voice, text, pcm, channels, sample_width, "
+                    "sample_rate, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, voice, normalize_text(text), pcm.data, pcm.channels, pcm.sample_width,
+                     pcm.sample_rate, len(pcm.data), now, now),
+                )
+                self._evict(conn)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tts_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute("SELECT cache_key, size FROM tts_cache ORDER BY last_used ASC"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM tts_cache WHERE cache_key=?", evicted)
+        self.evictions += len(evicted)
+        logging.debug(f"TTS cache evicted {len(evicted)} least recently used utterances")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            conn = self._connect()
+            conn.execute("DELETE FROM tts_cache")
+            conn.commit()
+            conn.close()
+
+    def stats(self):
+        """Hit/miss counters plus the current number and size of entries."""
+        with self._lock:
+            conn = self._connect()
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tts_cache").fetchone()
+            conn.close()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+            }
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_tts_cache():
+    """Returns the process-wide TTSCache, creating it on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TTSCache()
+        return _default_cache
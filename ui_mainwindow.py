@@ -4,10 +4,11 @@ import os
 import logging
 import importlib
 import re
+import time
 from PyQt5.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QToolButton, QPushButton, QLabel,
     QSplitter, QTextEdit, QLineEdit, QComboBox, QDockWidget, QMessageBox, QFileDialog,
-    QFrame, QGraphicsDropShadowEffect, QApplication
+    QFrame, QGraphicsDropShadowEffect, QApplication, QDialog, QTableWidget, QTableWidgetItem
 )
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QPoint, QSize, QEasingCurve, QPropertyAnimation
 from PyQt5.QtGui import QFont, QIcon, QTextCursor, QColor
@@ -16,8 +17,13 @@ from PyQt5.QtGui import QFont, QIcon, QTextCursor, QColor
 #from expert_mode import expert_mode_query
 from course_mode import load_demo_data
 from db import create_or_get_user
-from workers import AIWorker
-from course_data import get_class_units, build_llm_prompt, get_class_subjects
+from content_pack import open_content_pack
+from workers import AIWorker, TopicWarmer
+from ollama_integration import Conversation, PRIORITY_COURSE, PRIORITY_INTERACTIVE, prefill_stats
+from llm_metrics import get_metrics_recorder, METRICS_FIELDS
+from course_data import (
+    get_class_units, build_llm_prompt, build_llm_system_prompt, generation_options, get_class_subjects
+)
 from wait_function import BackgroundWaitFunction
 from tts import OfflineTTS
 
@@ -30,6 +36,22 @@ from lego_ai_bot import LegoAIBotWidget
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
+# Keywords in an AI answer -> simulation (keys of MainWindow.simulation_classes), in priority order
+SIMULATION_KEYWORDS = {
+    "pendulum": "Pendulum",
+    "projectile": "Projectile",
+    "circuit": "ElectricCircuit",
+    "string theory": "StringTheory",
+    "thermodynamics": "Thermodynamics",
+    "optic": "Optics",
+    "lens": "Optics",
+    "wave": "Wave",
+    "gravity": "Gravity",
+    "orbit": "Gravity",
+    "magnetic": "MagneticField"
+}
+SIMULATION_KEYWORD_OVERLAP = max(len(k) for k in SIMULATION_KEYWORDS) - 1  # Rescanned when new text arrives
+
 
 class MainWindow(QMainWindow):
     # Flow states for course/unit/topic selection
@@ -50,6 +72,7 @@ class MainWindow(QMainWindow):
         self.stt_engine = stt_engine
         self.tts_engine = tts_engine  # Instance of OfflineTTS
         self.voice_enabled = False  # Initially off
+        self._speech_streaming = False  # The current answer is spoken as it streams
 
         # Theme (default light mode)
         self.dark_mode = False
@@ -59,6 +82,9 @@ class MainWindow(QMainWindow):
         self.user_id = self.user_info[0]
         load_demo_data()
 
+        # Pre-generated curriculum answers (built with pregenerate.py), if present
+        self.content_pack = open_content_pack()
+
         # Flow tracking for course/unit/topic selection
         self.flow_state = self.STATE_IDLE
         self.selected_subject = None
@@ -66,6 +92,23 @@ class MainWindow(QMainWindow):
         self.selected_topic = None
         self.available_units = {}
         self.available_topics = {}
+        self.generation_options = None  # Length/temperature limits of the selected class level
+
+        # Free-form chat keeps its context across questions
+        self.conversation = Conversation()
+
+        # AIWorkers and their QThreads, kept referenced until each thread has finished
+        # (a cancelled worker may still be returning while the next question starts)
+        self._ai_workers = []
+
+        # Generates the selected class's topics into the response cache while slots are free
+        self.topic_warmer = None
+
+        # Streaming AI bubble (document position where it starts, text received so far)
+        self._stream_bubble_start = None
+        self._stream_text = ""
+        self._stream_simulation = None  # Simulation already opened from the streaming answer
+        self._stream_scanned = 0        # Characters of _stream_text already searched for keywords
 
         # Load simulation modules dynamically
         self.simulation_classes = {}
@@ -206,6 +249,14 @@ class MainWindow(QMainWindow):
         self.btn_courses.clicked.connect(self._toggle_course_dock)
         btn_layout.addWidget(self.btn_courses)
 
+        self.btn_metrics = QToolButton()
+        self.btn_metrics.setText("Metrics")
+        self.btn_metrics.setToolTip("LLM request timings")
+        self.btn_metrics.setCursor(Qt.PointingHandCursor)
+        self.btn_metrics.setStyleSheet("background: transparent; border: none;")
+        self.btn_metrics.clicked.connect(self._show_llm_metrics)
+        btn_layout.addWidget(self.btn_metrics)
+
         layout.addWidget(btn_container, alignment=Qt.AlignRight)
         return top_bar_widget
 
@@ -227,6 +278,49 @@ class MainWindow(QMainWindow):
     def _toggle_course_dock(self):
         self.course_dock.setVisible(not self.course_dock.isVisible())
 
+    def _show_llm_metrics(self):
+        """Shows the most recent LLM requests (newest first) with p50/p95 timings."""
+        recorder = get_metrics_recorder()
+        records = recorder.recent()[::-1]
+        summary = recorder.summary()
+
+        dialog = QDialog(self)
+        dialog.setWindowTitle("LLM Metrics")
+        dialog.resize(1000, 500)
+        layout = QVBoxLayout(dialog)
+
+        lines = [f"Requests: {summary['requests']}  Cache hits: {summary['cache_hits']}  Errors: {summary['errors']}"]
+        for field, label in (("queue_wait", "Queue wait"), ("ttft", "First token"), ("total", "Total")):
+            if f"{field}_p50" in summary:
+                lines.append(f"{label}: p50 {summary[field + '_p50']:.2f}s, p95 {summary[field + '_p95']:.2f}s")
+        if "tokens_per_second_p50" in summary:
+            lines.append(f"Tokens/s: p50 {summary['tokens_per_second_p50']:.1f}")
+        prefill = prefill_stats()
+        if prefill["prompt_tokens"]:
+            lines.append(f"Prefill: {prefill['reused_tokens']} of {prefill['prompt_tokens']} prompt tokens "
+                         f"reused ({prefill['reused_tokens'] / prefill['prompt_tokens']:.0%}), "
+                         f"about {prefill['saved_seconds']:.1f}s saved")
+        if self.tts_engine.cache is not None:
+            speech = self.tts_engine.cache.stats()
+            lines.append(f"Speech cache: {speech['hits']} hits, {speech['misses']} misses "
+                         f"({speech['hit_rate']:.0%}), {speech['bytes'] / 1e6:.1f} MB")
+        layout.addWidget(QLabel("\n".join(lines)))
+
+        table = QTableWidget(len(records), len(METRICS_FIELDS))
+        table.setHorizontalHeaderLabels(METRICS_FIELDS)
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        for row, record in enumerate(records):
+            for column, field in enumerate(METRICS_FIELDS):
+                value = record.get(field)
+                if field == "time":
+                    value = time.strftime("%H:%M:%S", time.localtime(value))
+                elif isinstance(value, float):
+                    value = f"{value:.3f}"
+                table.setItem(row, column, QTableWidgetItem("" if value is None else str(value)))
+        table.resizeColumnsToContents()
+        layout.addWidget(table)
+        dialog.exec_()
+
     # -------------------------
     # B. Course Sidebar (Dock) with Interactive Animations
     # -------------------------
@@ -332,18 +426,41 @@ class MainWindow(QMainWindow):
         self.flow_state = self.STATE_IDLE
         self.selected_subject = subject
         self.selected_class_number = class_number
+        self.generation_options = generation_options(class_number)
         self.flow_state = self.STATE_AWAIT_UNIT
         self.available_units = get_class_units(class_number, subject)
         if not self.available_units:
             self._append_chat_message("No data available for this subject.", sender='ai')
             self.flow_state = self.STATE_IDLE
             return
+        self._start_topic_warmer(class_number, subject)
         lines = [f"Welcome to Class {class_number} {subject}!",
                  "Here are the available units:\n"]
         for unit_num, unit_info in self.available_units.items():
             lines.append(f"{unit_num}. {unit_info['name']}")
         lines.append("Please type the unit number (e.g., 1, 2) in the chat to proceed, or 'stop' to cancel.")
         self._append_chat_message("\n".join(lines), sender='ai')
+        if self.voice_enabled:
+            self.tts_engine.speak("\n".join(lines))
+
+    def _start_topic_warmer(self, class_number, subject):
+        """Warms the cache with every topic of the chosen subject that the content pack does not cover."""
+        self._stop_topic_warmer()
+        jobs = []
+        for unit_number, unit_info in self.available_units.items():
+            for topic in unit_info['topics']:
+                prompt = build_llm_prompt(class_number, subject, unit_number, topic)
+                system = build_llm_system_prompt(class_number, subject)
+                if not (self.content_pack and self.content_pack.get(prompt, system)):
+                    jobs.append((prompt, system))
+        if jobs:
+            self.topic_warmer = TopicWarmer(jobs, options=self.generation_options, user=self.user_id)
+            self.topic_warmer.start()
+
+    def _stop_topic_warmer(self):
+        if self.topic_warmer:
+            self.topic_warmer.cancel()
+            self.topic_warmer = None
 
     def user_selected_unit(self, unit_number: str):
         if unit_number not in self.available_units:
@@ -358,6 +475,8 @@ class MainWindow(QMainWindow):
             lines.append(f"{i}. {topic_name}")
         lines.append("Please type the topic number or name. Type 'stop' to cancel.")
         self._append_chat_message("\n".join(lines), sender='ai')
+        if self.voice_enabled:
+            self.tts_engine.speak("\n".join(lines))
 
     def user_selected_topic(self, topic_input: str):
         try:
@@ -375,10 +494,20 @@ class MainWindow(QMainWindow):
                 return
         self.selected_topic = topic_name
         prompt = build_llm_prompt(self.selected_class_number, self.selected_subject, self.selected_unit_number, topic_name)
+        system = build_llm_system_prompt(self.selected_class_number, self.selected_subject)
         self.flow_state = self.STATE_IDLE
         self._append_chat_message(f"You selected topic: {topic_name}", sender='user')
         self._append_chat_message("Sending a special prompt to the LLM now...", sender='ai')
-        self._send_to_llm(prompt)
+        self._send_to_llm(prompt, system)
+
+    def closeEvent(self, event):
+        # Cancelled requests are aborted at once, so their threads finish before the window goes
+        for worker, thread in self._ai_workers:
+            if not thread.isFinished():
+                worker.cancel()
+                thread.wait(5000)
+        self._stop_topic_warmer()
+        super().closeEvent(event)
 
     def _stop_flow(self):
         logging.debug("Stopping flow...")
@@ -389,21 +518,17 @@ class MainWindow(QMainWindow):
         self.selected_topic = None
         self.available_units = {}
         self.available_topics = {}
-        if hasattr(self, 'worker') and hasattr(self, 'worker_thread'):
-            try:
-                self.worker.cancel()
-                if self.worker_thread.isRunning():
-                    self.worker_thread.quit()
-                    self.worker_thread.wait()
-            except Exception as e:
-                logging.debug(f"AIWorker cancellation issue: {e}")
-        if self.voice_enabled and self.tts_engine.tts_thread:
-            try:
-                if self.tts_engine.tts_thread.isRunning():
-                    self.tts_engine.tts_thread.terminate()
-                    self.tts_engine.tts_thread.wait()
-            except Exception as e:
-                logging.debug(f"TTS termination issue: {e}")
+        self.generation_options = None
+        self._stop_topic_warmer()
+        if hasattr(self, 'worker'):
+            # Returns promptly: the request is aborted, and the thread quits once run() is done
+            self.worker.cancel()
+        if self._stream_bubble_start is not None:
+            self._stream_bubble_start = None
+            self._stream_simulation = None
+            self.background_wait_function.stop_waiting()
+        self._speech_streaming = False
+        self.tts_engine.stop()
         self.question_input.setDisabled(False)
         logging.debug("Flow stopped.")
 
@@ -563,6 +688,7 @@ class MainWindow(QMainWindow):
                     loaded_content = f.read()
                 self.chat_display.clear()
                 self.chat_display.append(loaded_content)
+                self.conversation.reset()
                 QMessageBox.information(self, "Load Chat", f"Chat loaded from {filename}.")
             except Exception as e:
                 logging.error(f"Load chat failed: {e}")
@@ -665,6 +791,13 @@ class MainWindow(QMainWindow):
             return
 
         # ----- AI BUBBLE -----
+        self.chat_display.append(self._format_ai_bubble(message))
+        self.chat_display.moveCursor(QTextCursor.End)
+
+    def _format_ai_bubble(self, message):
+        """
+        Builds the HTML for an AI bubble, splitting 'Reasoning' from 'Answer'.
+        """
         # 1. Split lines
         lines = message.splitlines()
 
@@ -724,56 +857,126 @@ class MainWindow(QMainWindow):
         )
 
         # Combine everything
-        bubble = bubble_top + reasoning_section + answer_section + bubble_bottom
-        self.chat_display.append(bubble)
+        return bubble_top + reasoning_section + answer_section + bubble_bottom
+
+    def _begin_ai_stream(self, placeholder):
+        """
+        Appends a placeholder AI bubble that streamed text then grows in place.
+        """
+        document = self.chat_display.document()
+        self._stream_bubble_start = 0 if document.isEmpty() else document.characterCount()
+        self._stream_text = ""
+        self._stream_simulation = None
+        self._stream_scanned = 0
+        self._append_chat_message(placeholder, sender='ai')
+        # In voice mode the answer is spoken sentence by sentence while it streams
+        self._speech_streaming = self.voice_enabled
+        if self._speech_streaming:
+            self.tts_engine.start_stream()
+
+    def _replace_ai_stream_bubble(self, message):
+        """
+        Re-renders the streaming AI bubble (everything after its start position) with 'message'.
+        """
+        cursor = QTextCursor(self.chat_display.document())
+        cursor.setPosition(self._stream_bubble_start)
+        cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        cursor.insertHtml(self._format_ai_bubble(message))
         self.chat_display.moveCursor(QTextCursor.End)
 
+    def _handle_ai_partial(self, piece):
+        if self._stream_bubble_start is None:
+            return
+        self._stream_text += piece
+        if self._speech_streaming:
+            self.tts_engine.feed(piece)
+        self._replace_ai_stream_bubble(self._stream_text)
+        self._scan_stream_for_simulation()
+
+    def _scan_stream_for_simulation(self):
+        """
+        Opens the matching simulation as soon as its keyword appears in the streaming answer,
+        instead of waiting for the whole answer. Only the text added since the last scan (plus
+        enough overlap to catch a keyword split across pieces) is searched.
+        """
+        if self._stream_simulation is not None:
+            return
+        start = max(0, self._stream_scanned - SIMULATION_KEYWORD_OVERLAP)
+        sim_name = self._match_simulation(self._stream_text[start:])
+        self._stream_scanned = len(self._stream_text)
+        if sim_name:
+            logging.debug(f"Opening simulation '{sim_name}' while the answer streams")
+            self._stream_simulation = sim_name
+            self._show_simulation(sim_name)
+
     def _process_user_message(self, message):
         logging.debug("Processing query with Prof...")
-        self._append_chat_message("Processing...", sender='ai')
-        self.question_input.setDisabled(True)
         self.lego_bot.setThinking()
-        self.worker = AIWorker(message)
+        self._start_ai_worker(message, "Processing...", conversation=self.conversation, semantic_cache=True)
+
+    def _start_ai_worker(self, prompt, placeholder, use_cache=False, conversation=None, system=None,
+                         semantic_cache=False, priority=PRIORITY_INTERACTIVE):
+        """
+        Runs an AIWorker for 'prompt' on its own thread, streaming its output into
+        a single AI bubble that starts out showing 'placeholder'. Generations are bounded
+        by the selected class level's generation_options.
+        """
+        self._begin_ai_stream(placeholder)
+        self.question_input.setDisabled(True)
+        self.worker = AIWorker(prompt, use_cache=use_cache, conversation=conversation, system=system,
+                               semantic_cache=semantic_cache, options=self.generation_options,
+                               priority=priority, user=self.user_id)
         self.worker_thread = QThread()
         self.worker.moveToThread(self.worker_thread)
         self.worker_thread.started.connect(self.worker.run)
+        self.worker.partial.connect(self._handle_ai_partial)
         self.worker.finished.connect(self._handle_ai_response)
-        self.worker.finished.connect(self.worker_thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.worker_thread.finished.connect(self.worker_thread.deleteLater)
         self.worker.error.connect(self._handle_ai_error)
+        for done in (self.worker.finished, self.worker.cancelled, self.worker.error):
+            done.connect(self.worker_thread.quit)
+        self._ai_workers = [(w, t) for w, t in self._ai_workers if not t.isFinished()]
+        self._ai_workers.append((self.worker, self.worker_thread))
         self.background_wait_function.start_waiting()
         self.worker_thread.start()
 
-    def _handle_ai_response(self, response):
-        self._append_chat_message(response, sender='ai')
+    def _handle_ai_response(self, response, audio=None):
+        if self._stream_bubble_start is not None:
+            self._replace_ai_stream_bubble(response)
+            self._stream_bubble_start = None
+        else:
+            self._append_chat_message(response, sender='ai')
         self.background_wait_function.stop_waiting()
-        if self.voice_enabled:
-            self.tts_engine.speak(response)
+        if self._speech_streaming:
+            if not self._stream_text:
+                self.tts_engine.feed(response)  # Answered in one piece (e.g. a semantic cache hit)
+            self.tts_engine.end_stream()
+            self._speech_streaming = False
+        elif self.voice_enabled:
+            self.tts_engine.speak(response, audio=audio)
         self.lego_bot.setSpeaking()
         QTimer.singleShot(1500, self.lego_bot.setIdle)
         self.question_input.setDisabled(False)
         self._trigger_simulation(response)
 
     def _handle_ai_error(self, error_msg):
+        if self._speech_streaming:
+            self._speech_streaming = False
+            self.tts_engine.stop()
+        self._stream_bubble_start = None
+        self._stream_simulation = None
         self._append_chat_message(f"Error: {error_msg}", sender='ai')
         self.question_input.setDisabled(False)
         self.background_wait_function.stop_waiting()
 
-    def _send_to_llm(self, prompt):
-        self._append_chat_message("Processing specialized topic prompt...", sender='ai')
-        self.question_input.setDisabled(True)
-        self.thread = QThread()
-        self.worker = AIWorker(prompt)
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self._handle_ai_response)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.worker.error.connect(self._handle_ai_error)
-        self.background_wait_function.start_waiting()
-        self.thread.start()
+    def _send_to_llm(self, prompt, system=None):
+        entry = self.content_pack.get(prompt, system) if self.content_pack else None
+        if entry:
+            logging.debug("Serving topic from content pack.")
+            self._handle_ai_response(entry[0], audio=entry[1])
+            return
+        # Curriculum prompts are deterministic, so repeated topic selections are served from the cache
+        self._start_ai_worker(prompt, "Processing specialized topic prompt...", use_cache=True, system=system,
+                              priority=PRIORITY_COURSE)
 
     # -------------
     # D. Simulation Panel (Automatically Expands)
@@ -789,42 +992,40 @@ class MainWindow(QMainWindow):
         layout.addWidget(placeholder)
         return sim_widget
 
+    @staticmethod
+    def _match_simulation(text):
+        """Returns the simulation for the first SIMULATION_KEYWORDS keyword found in 'text', or None."""
+        txt = text.lower()
+        for key, sname in SIMULATION_KEYWORDS.items():
+            if key in txt:
+                return sname
+        return None
+
     def _trigger_simulation(self, text_response):
         """
         Checks the AI response for simulation-related keywords.
         If found, automatically loads the corresponding simulation and expands the simulation panel.
-        Otherwise, the simulation panel is collapsed.
+        Otherwise, the simulation panel is collapsed. A simulation already opened while the
+        answer streamed is kept as it is.
         """
-        txt = text_response.lower()
-        simulation_map = {
-            "pendulum": "Pendulum",
-            "projectile": "Projectile Motion",
-            "circuit": "Electric Circuit",
-            "string theory": "String Theory",
-            "thermodynamics": "Thermodynamics",
-            "optic": "Optics (Lens)",
-            "lens": "Optics (Lens)",
-            "wave": "Waves (Standing Wave)",
-            "gravity": "Gravity (Orbits)",
-            "orbit": "Gravity (Orbits)",
-            "magnetic": "Magnetic Fields"
-        }
-        matched = False
-        sim_name = None
-        for key, sname in simulation_map.items():
-            if key in txt:
-                matched = True
-                sim_name = sname
-                break
-        totalWidth = self.central_splitter.width()
-        if matched:
-            self._select_simulation(sim_name)
-            simulationWidth = 600  # Desired simulation panel width
-            chatWidth = totalWidth - simulationWidth
-            self.central_splitter.setSizes([chatWidth, simulationWidth])
+        if self._stream_simulation is not None:
+            self._stream_simulation = None
+            return
+        sim_name = self._match_simulation(text_response)
+        if sim_name:
+            self._show_simulation(sim_name)
         else:
+            totalWidth = self.central_splitter.width()
             self.central_splitter.setSizes([totalWidth, 0])
 
+    def _show_simulation(self, sim_name):
+        """Loads 'sim_name' into the simulation panel and expands it."""
+        self._select_simulation(sim_name)
+        totalWidth = self.central_splitter.width()
+        simulationWidth = 600  # Desired simulation panel width
+        chatWidth = totalWidth - simulationWidth
+        self.central_splitter.setSizes([chatWidth, simulationWidth])
+
     def _select_simulation(self, sim_name):
         layout = self.simulation_panel.layout()
         while layout.count():
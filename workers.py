@@ -1,18 +1,246 @@
 # workers.py
+import asyncio
+import itertools
+import logging
+import threading
+import time
 from PyQt5.QtCore import QObject, pyqtSignal, QThread
-from ollama_integration import ask_ai
+from ollama_integration import (
+    ask_ai, CancelToken, DEFAULT_MODEL, GenerationPreempted, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+)
+from llm_metrics import get_metrics_recorder
+
+PARTIAL_EMIT_INTERVAL = 0.05  # Seconds between 'partial' signals; pieces arriving in between are batched
+WARM_RETRY_DELAY = 2.0        # Seconds before TopicWarmer retries a generation a student's request preempted
 
 class AIWorker(QObject):
+    partial = pyqtSignal(str)   # Signal to emit each piece of the response as it streams in
     finished = pyqtSignal(str)  # Signal to emit the AI response
     error = pyqtSignal(str)     # Signal to emit error messages
+    cancelled = pyqtSignal()    # Signal emitted instead of 'finished' after cancel()
 
-    def __init__(self, prompt):
+    def __init__(self, prompt, use_cache=False, model=DEFAULT_MODEL, conversation=None, system=None,
+                 semantic_cache=False, options=None, priority=PRIORITY_INTERACTIVE, user=None):
         super().__init__()
         self.prompt = prompt
+        self.system = system  # Fixed instructions kept out of 'prompt' so Ollama can reuse their prefill
+        self.model = model
+        self.conversation = conversation  # ollama_integration.Conversation to continue, if any
+        self.use_cache = use_cache  # Reuse stored answers for deterministic (curriculum) prompts
+        self.semantic_cache = semantic_cache  # Reuse answers to similarly worded free-chat questions
+        self.options = options  # Ollama generation options, e.g. course_data.generation_options()
+        self.priority = priority  # ollama_integration.PRIORITY_*; decides the order of waiting requests
+        self.user = user  # Requests are shared fairly between users waiting at the same priority
+        self.emit_interval = PARTIAL_EMIT_INTERVAL
+        self._pending = []
+        self._last_emit = 0.0
+        self._flusher = None  # Thread emitting pieces still queued when 'emit_interval' runs out
+        self._flush_done = False
+        self._partial_cond = threading.Condition()
+        self._cancel = CancelToken()
 
     def run(self):
         try:
-            response = ask_ai(self.prompt,model="ollama")
-            self.finished.emit(response)
+            started = time.perf_counter()
+            cache, vector = self._semantic_cache()
+            match = cache.lookup(vector, self.options) if vector is not None else None
+            if match is not None:
+                response = match[0]
+                logging.debug(f"Semantic cache hit (similarity {match[1]:.3f})")
+                elapsed = time.perf_counter() - started
+                get_metrics_recorder().record({"backend": "semantic", "cache": "hit", "status": "ok",
+                                               "ttft": elapsed, "total": elapsed})
+                if self.conversation is not None:
+                    self.conversation.remember(self.prompt, response)
+            else:
+                meta = {}
+                if self.conversation is not None:
+                    response = self.conversation.ask(self.prompt, on_token=self._emit_partial, meta=meta,
+                                                     use_cache=self.use_cache, cancel=self._cancel,
+                                                     options=self.options, priority=self.priority, user=self.user)
+                else:
+                    response = ask_ai(self.prompt, model=self.model, on_token=self._emit_partial, meta=meta,
+                                      use_cache=self.use_cache, cancel=self._cancel, system=self.system,
+                                      options=self.options, priority=self.priority, user=self.user)
+                if vector is not None and response and not meta.get("error") and not self._cancel.cancelled:
+                    cache.store(self.prompt, response, vector, self.options)
+            if self._cancel.cancelled:
+                self._stop_flusher(flush=False)
+                self.cancelled.emit()
+            else:
+                self._stop_flusher()
+                self.finished.emit(response)
         except Exception as e:
+            self._stop_flusher(flush=False)
             self.error.emit(str(e))
+
+    def _semantic_cache(self):
+        """
+        (cache, question embedding) when the semantic cache applies, else (None, None).
+        Follow-up questions depend on the conversation so far, so only a question that
+        starts a conversation is looked up or stored.
+        """
+        if not self.semantic_cache or self.system or (self.conversation and self.conversation.has_history()):
+            return None, None
+        from semantic_cache import get_semantic_cache  # Needs NumPy; only loaded when used
+        cache = get_semantic_cache()
+        return cache, cache.embed(self.prompt, self._cancel)
+
+    def _emit_partial(self, piece):
+        """
+        Queues 'piece' for the GUI. The first piece goes out at once; after that, pieces are
+        joined and emitted at most every 'emit_interval' seconds, so a fast model doesn't
+        make the GUI thread re-render the answer once per token. One flusher thread, started
+        with the first piece that has to wait and kept until run() ends, emits whatever is
+        queued when the interval runs out, so a piece never waits longer than that for the
+        next one to arrive.
+        """
+        if self._cancel.cancelled:
+            return
+        with self._partial_cond:
+            self._pending.append(piece)
+            now = time.monotonic()
+            if self._last_emit + self.emit_interval <= now:
+                self._flush_pending(now)
+            elif self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="AIWorkerFlush", daemon=True)
+                self._flusher.start()
+            elif len(self._pending) == 1:
+                self._partial_cond.notify()  # The flusher is idle until something is queued
+
+    def _flush_loop(self):
+        with self._partial_cond:
+            while not self._flush_done:
+                if not self._pending:
+                    self._partial_cond.wait()
+                    continue
+                wait = self._last_emit + self.emit_interval - time.monotonic()
+                if wait > 0:
+                    self._partial_cond.wait(wait)
+                else:
+                    self._flush_pending()
+
+    def _flush_pending(self, now=None):
+        # Called with _partial_cond held, so 'partial' signals go out in order
+        if self._cancel.cancelled:
+            self._pending = []
+        elif self._pending:
+            self.partial.emit("".join(self._pending))
+            self._pending = []
+            self._last_emit = now or time.monotonic()
+
+    def _stop_flusher(self, flush=True):
+        """Ends the flusher thread; with 'flush', pieces still queued are emitted first."""
+        with self._partial_cond:
+            self._flush_done = True
+            self._partial_cond.notify()
+            if flush:
+                self._flush_pending()
+        if self._flusher is not None:
+            self._flusher.join()
+
+    def cancel(self):
+        """
+        Stops the generation; safe to call from the GUI thread. The HTTP stream is closed
+        immediately, so Ollama stops generating and run() returns promptly.
+        """
+        self._cancel.cancel()
+
+class TopicWarmer:
+    """
+    Generates curriculum answers into the response cache on a daemon thread at
+    PRIORITY_BACKGROUND, so they are ready when a student picks the topic. It only uses
+    slots nobody else is waiting for: a student's request preempts the running generation,
+    which is retried after WARM_RETRY_DELAY.
+    """
+
+    def __init__(self, jobs, options=None, user=None, model=DEFAULT_MODEL):
+        self.jobs = list(jobs)  # (prompt, system) pairs, requested exactly as MainWindow requests them
+        self.options = options
+        self.user = user
+        self.model = model  # Part of the cache key, so it must match the model the topic requests use
+        self._cancel = CancelToken()
+        self._thread = threading.Thread(target=self._run, name="TopicWarmer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        """Stops warming; the running request is aborted and nothing partial is cached."""
+        self._cancel.cancel()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        for prompt, system in self.jobs:
+            while not self._cancel.cancelled:
+                try:
+                    # Not coalesced: a student joining this generation would share its preemption
+                    ask_ai(prompt, model=self.model, use_cache=True, raise_errors=True, coalesce=False,
+                           cancel=self._cancel, system=system, options=self.options,
+                           priority=PRIORITY_BACKGROUND, user=self.user)
+                    break
+                except GenerationPreempted:
+                    self._cancel.wait(WARM_RETRY_DELAY)
+                except Exception as e:
+                    logging.warning(f"Cache warming stopped: {e}")
+                    return
+            if self._cancel.cancelled:
+                return
+
+class AsyncAIBridge(QObject):
+    """
+    Runs every AI request on one shared asyncio event loop thread (see ollama_async)
+    instead of one QThread per question. Each submit() returns a request id that the
+    signals carry, and that cancel() accepts.
+    """
+    partial = pyqtSignal(int, str)   # request id, next piece of the response
+    finished = pyqtSignal(int, str)  # request id, full response
+    error = pyqtSignal(int, str)     # request id, error message
+    cancelled = pyqtSignal(int)      # request id
+
+    def __init__(self, max_concurrent=None):
+        super().__init__()
+        from ollama_async import AsyncLLMClient, ASYNC_MAX_CONCURRENT
+        self._loop = asyncio.new_event_loop()
+        self._client = AsyncLLMClient(max_concurrent or ASYNC_MAX_CONCURRENT)
+        self._ids = itertools.count(1)
+        self._futures = {}
+        self._thread = threading.Thread(target=self._loop.run_forever, name="AsyncAIBridge", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, model="ollama", use_cache=False, context=None, system=None, options=None,
+               priority=PRIORITY_INTERACTIVE, user=None):
+        """Starts a request (arguments as for ask_ai) and returns its id."""
+        request_id = next(self._ids)
+        kwargs = {"model": model, "use_cache": use_cache, "context": context, "system": system,
+                  "options": options, "priority": priority, "user": user}
+        future = asyncio.run_coroutine_threadsafe(self._run(request_id, prompt, kwargs), self._loop)
+        self._futures[request_id] = future
+        future.add_done_callback(lambda f, rid=request_id: self._futures.pop(rid, None))
+        return request_id
+
+    async def _run(self, request_id, prompt, kwargs):
+        try:
+            response = await self._client.ask(prompt, on_token=lambda piece: self.partial.emit(request_id, piece),
+                                              **kwargs)
+            self.finished.emit(request_id, response)
+        except asyncio.CancelledError:
+            self.cancelled.emit(request_id)
+            raise
+        except Exception as e:
+            self.error.emit(request_id, str(e))
+
+    def cancel(self, request_id):
+        """Cancels a running request; its HTTP stream is closed on the loop thread."""
+        future = self._futures.get(request_id)
+        if future:
+            future.cancel()
+
+    def shutdown(self):
+        for future in list(self._futures.values()):
+            future.cancel()
+        asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)